@@ -0,0 +1,309 @@
+"""Нагрузочный тест бота: синтетические обновления на /webhook и заглушка Bot API.
+
+Запуск: python bench.py --users 20 --history 1000 --iterations 5
+Сеть не нужна: запросы бота к Telegram принимает локальный HTTP-сервер.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+# ==================== ЗАГЛУШКА BOT API ====================
+class StubApi:
+    """Принимает запросы бота и считает ответы по чатам"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.replies = defaultdict(int)  # chat_id -> число полученных запросов
+        self.methods = defaultdict(int)
+        self.message_ids = itertools.count(1)
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True  # иначе keep-alive ответы ждут задержанного ACK
+
+            def do_GET(self):
+                self.handle_call()
+
+            def do_POST(self):
+                self.handle_call()
+
+            def handle_call(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    self.rfile.read(length)
+                url = urlparse(self.path)
+                method = url.path.rsplit("/", 1)[-1]
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                body = json.dumps({"ok": True, "result": stub.result(method, params)}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/bot{{0}}/{{1}}"
+
+    def result(self, method, params):
+        if not method.startswith("send"):
+            return True
+        chat_id = int(params.get("chat_id", 0))
+        message_id = next(self.message_ids)
+        result = {"message_id": message_id, "date": int(time.time()),
+                  "chat": {"id": chat_id, "type": "private"}}
+        if method == "sendPhoto":
+            result["photo"] = [{"file_id": f"photo{message_id}", "file_unique_id": f"u{message_id}",
+                                "width": 800, "height": 400}]
+        with self.cond:
+            self.replies[chat_id] += 1
+            self.methods[method] += 1
+            self.cond.notify_all()
+        return result
+
+    def count(self, chat_id):
+        with self.cond:
+            return self.replies[chat_id]
+
+    def wait(self, chat_id, expected, timeout):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.replies[chat_id] >= expected, timeout)
+
+
+# ==================== СЦЕНАРИИ ====================
+# Каждое сообщение сценария получает ровно один ответ бота (текст или график)
+FLOWS = {
+    "product_amount": lambda user, i, rnd: ["курица", str(rnd.randint(50, 400))],
+    "add_product": lambda user, i, rnd: ["➕ Добавить продукт", f"бенч {user} {i}:{rnd.randint(20, 600)}"],
+    "remove_product": lambda user, i, rnd: ["❌ Удалить продукт", f"бенч {user} {i}"],
+    "history": lambda user, i, rnd: ["📜 История"],
+    "week_plot": lambda user, i, rnd: ["📈 График за неделю"],
+    "pie_chart": lambda user, i, rnd: ["🥧 Топ продуктов"],
+}
+
+CHAT_BASE = 10_000_000
+
+
+def fill_history(bot, users, size, rnd):
+    """Заранее накопленная история: size записей на пользователя за последние 60 дней"""
+    from datetime import date, timedelta
+    names = list(bot.products)
+    today = date.today()
+    for user in range(users):
+        user_id = str(CHAT_BASE + user)
+        for start in range(0, size, 500):
+            entries = []
+            for _ in range(min(500, size - start)):
+                product = rnd.choice(names)
+                amount = rnd.randint(20, 400)
+                entries.append({
+                    "product": product,
+                    "amount": amount,
+                    "calories": int(bot.products[product] * amount / 100),
+                    "date": (today - timedelta(days=rnd.randint(0, 59))).isoformat(),
+                })
+            bot.store.commit({"op": "entries", "user": user_id, "entries": entries})
+    bot.store.flush()
+
+
+def run_user(user, args, webhook_url, stub, update_ids, latencies, errors, measure):
+    """Сценарии одного пользователя подряд: следующее сообщение — после ответа на предыдущее"""
+    rnd = random.Random(args.seed * 100003 + user)
+    chat_id = CHAT_BASE + user
+    session = requests.Session()
+    iterations = args.iterations if measure else args.warmup
+    for i in range(iterations):
+        for flow in args.flows:
+            for text in FLOWS[flow](user, f"{int(measure)}-{i}", rnd):
+                update = {
+                    "update_id": next(update_ids),
+                    "message": {
+                        "message_id": 1, "date": int(time.time()), "text": text,
+                        "chat": {"id": chat_id, "type": "private"},
+                        "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+                    },
+                }
+                expected = stub.count(chat_id) + 1
+                started = time.perf_counter()
+                response = session.post(webhook_url, json=update, timeout=30)
+                if response.status_code != 200 or not stub.wait(chat_id, expected, args.timeout):
+                    errors.append((flow, text, response.status_code))
+                    continue
+                if measure:
+                    latencies[flow].append(time.perf_counter() - started)
+
+
+# ==================== ИЗМЕРЕНИЯ ====================
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def memory_usage():
+    """(текущий, максимальный) RSS процесса в байтах"""
+    values = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    values[key] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    peak = values.get("VmHWM") or resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return values.get("VmRSS", peak), peak
+
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def run_phase(args, webhook_url, stub, update_ids, measure):
+    latencies = defaultdict(list)
+    errors = []
+    threads = [
+        threading.Thread(target=run_user, args=(user, args, webhook_url, stub, update_ids, latencies, errors, measure))
+        for user in range(args.users)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10, help="одновременных пользователей")
+    parser.add_argument("--history", type=int, default=200, help="записей истории у каждого до начала")
+    parser.add_argument("--iterations", type=int, default=3, help="повторов всех сценариев на пользователя")
+    parser.add_argument("--warmup", type=int, default=1, help="повторов до начала замеров")
+    parser.add_argument("--flows", default=",".join(FLOWS), help="сценарии через запятую: " + ", ".join(FLOWS))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=60, help="секунд ожидания ответа бота")
+    parser.add_argument("--telegram-limits", action="store_true",
+                        help="оставить лимиты отправки Telegram (по умолчанию сняты)")
+    parser.add_argument("--json", help="сохранить результаты в файл JSON")
+    args = parser.parse_args()
+    args.flows = [flow.strip() for flow in args.flows.split(",") if flow.strip()]
+    unknown = [flow for flow in args.flows if flow not in FLOWS]
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(unknown)}")
+
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    # Настройки бота читаются при импорте: всё окружение — до import bot
+    workdir = tempfile.mkdtemp(prefix="calbot-bench-")
+    os.chdir(workdir)
+    os.environ.setdefault("TOKEN", "123456:BENCH")
+    os.environ["DATA_DIR"] = os.path.join(workdir, "data")
+    if not args.telegram_limits:
+        os.environ.setdefault("SEND_RATE", "1000000")
+        os.environ.setdefault("SEND_CHAT_RATE", "1000000")
+    stub = StubApi()
+    from telebot import apihelper
+    apihelper.API_URL = stub.url
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import logging
+    logging.disable(logging.INFO)
+    import bot
+    import storage
+    from werkzeug.serving import make_server
+
+    server = make_server("127.0.0.1", 0, bot.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    webhook_url = f"http://127.0.0.1:{server.server_port}/webhook"
+
+    fill_started = time.perf_counter()
+    fill_history(bot, args.users, args.history, random.Random(args.seed))
+    fill_seconds = time.perf_counter() - fill_started
+
+    update_ids = itertools.count(1)
+    if args.warmup:
+        run_phase(args, webhook_url, stub, update_ids, measure=False)
+    bot.store.flush()
+    written_before = storage.flush_bytes.value
+    disk_before = dir_size(os.environ["DATA_DIR"])
+    latencies, errors, seconds = run_phase(args, webhook_url, stub, update_ids, measure=True)
+    bot.store.flush()
+    written = storage.flush_bytes.value - written_before
+    disk_growth = dir_size(os.environ["DATA_DIR"]) - disk_before
+
+    rss, max_rss = memory_usage()
+    all_latencies = [value for values in latencies.values() for value in values]
+    updates = len(all_latencies)
+    report = {
+        "users": args.users,
+        "history": args.history,
+        "iterations": args.iterations,
+        "history_fill_seconds": round(fill_seconds, 3),
+        "updates": updates,
+        "errors": len(errors),
+        "seconds": round(seconds, 3),
+        "throughput_updates_per_second": round(updates / seconds, 1) if seconds else 0,
+        "p50_ms": round(percentile(all_latencies, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(all_latencies, 0.99) * 1000, 2),
+        "flows": {
+            flow: {
+                "updates": len(values),
+                "p50_ms": round(percentile(values, 0.5) * 1000, 2),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+            }
+            for flow, values in latencies.items()
+        },
+        "rss_bytes": rss,
+        "max_rss_bytes": max_rss,
+        "storage_bytes_written_per_update": round(written / updates, 1) if updates else 0,
+        "data_dir_growth_bytes_per_update": round(disk_growth / updates, 1) if updates else 0,
+        "api_calls": dict(stub.methods),
+    }
+
+    print(f"Пользователей: {args.users}, записей истории: {args.history}, повторов: {args.iterations}")
+    print(f"Обновлений: {updates} за {seconds:.2f} с ({report['throughput_updates_per_second']}/с), "
+          f"ошибок: {len(errors)}")
+    print(f"Задержка до ответа: p50 {report['p50_ms']} мс, p99 {report['p99_ms']} мс")
+    for flow, stats in report["flows"].items():
+        print(f"  {flow:<16} {stats['updates']:>6}  p50 {stats['p50_ms']:>8} мс  p99 {stats['p99_ms']:>8} мс")
+    print(f"RSS: {report['rss_bytes'] / 2 ** 20:.1f} МБ (максимум {report['max_rss_bytes'] / 2 ** 20:.1f} МБ)")
+    print(f"Записано хранилищем: {report['storage_bytes_written_per_update']} байт на обновление, "
+          f"рост данных: {report['data_dir_growth_bytes_per_update']} байт на обновление")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    server.shutdown()
+    bot.store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,152 +1,622 @@
+import asyncio
+import contextvars
+import csv
+import hashlib
+import heapq
+import hmac
 import logging
 import os
 import json
+import multiprocessing
+import queue
+import re
+import signal
+import sys
+import tempfile
+import threading
 import time
-from datetime import datetime
-from collections import defaultdict
-from io import BytesIO
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, wraps
+from itertools import chain, islice
+from io import BytesIO, StringIO
+from urllib.parse import parse_qs
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 from dotenv import load_dotenv
+import requests
 import telebot
-from telebot.types import ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telebot import apihelper
+from telebot.types import (
+    InlineKeyboardButton, InlineKeyboardMarkup, JsonSerializable, ReplyKeyboardMarkup, ReplyKeyboardRemove,
+)
 from flask import Flask, request
 
+import catalog
+import charts
+import metrics
+import outbound
+import profiler
+import storage
+
+if __name__ == '__main__':
+    # python bot.py перезапускается как импорт модуля bot (см. main): у __main__
+    # тогда нет файла, и дочерние процессы (пул графиков) не выполняют bot.py
+    # заново как __mp_main__ — со своими потоками и открытыми данными
+    bot_dir = os.path.dirname(os.path.abspath(__file__))
+    os.execv(sys.executable, [
+        sys.executable, "-c", f"import sys; sys.path.insert(0, {bot_dir!r}); import bot; bot.main()",
+    ])
+
 # ==================== НАСТРОЙКА ====================
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Этапы запуска: время каждого попадает в лог и в метрику startup_phase_seconds
+STARTUP_BEGAN = time.perf_counter()
+startup_seconds = metrics.gauge_family("startup_phase_seconds", "Длительность этапов запуска", "phase")
+
+@contextmanager
+def startup_phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        startup_seconds.labels(name).set(round(seconds, 4))
+        logger.info(f"Этап запуска {name}: {seconds:.3f} с")
+
 load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
 TOKEN = os.getenv('TOKEN')
 if not TOKEN:
     logger.error("Токен бота не указан в переменных окружения!")
     exit(1)
 
-bot = telebot.TeleBot(TOKEN)
+RUNTIME = os.getenv('RUNTIME', 'flask')  # flask | asgi
+WORKERS = int(os.getenv('WORKERS', 1))  # процессов; больше одного — общий режим хранилища
+
+handler_seconds = metrics.histogram_family("bot_handler_seconds", "Время работы обработчика обновления", "handler")
+action_seconds = metrics.histogram_family("bot_action_seconds", "Время работы действия, выбранного route_text", "action")
+
+class CalorieBot(telebot.TeleBot):
+    """TeleBot, исходящие запросы которого можно перенаправить.
+
+    route — функция (метод, args, kwargs) -> результат; пока она не задана,
+    запросы выполняются как обычно. По умолчанию запросы ставятся в очередь
+    отправки без ожидания ответа (send_later), asyncio-режим подставляет свою.
+    """
+    route = None
+
+    def send_message(self, *args, **kwargs):
+        return self._outgoing("send_message", args, kwargs)
+
+    def send_photo(self, *args, **kwargs):
+        return self._outgoing("send_photo", args, kwargs)
+
+    def send_document(self, *args, **kwargs):
+        return self._outgoing("send_document", args, kwargs)
+
+    def edit_message_text(self, *args, **kwargs):
+        return self._outgoing("edit_message_text", args, kwargs)
+
+    def answer_callback_query(self, *args, **kwargs):
+        return self._outgoing("answer_callback_query", args, kwargs)
+
+    @staticmethod
+    def _build_handler_dict(handler, pass_bot=False, **filters):
+        # Каждый регистрируемый обработчик (@bot.message_handler и другие)
+        # оборачивается замером времени; сама функция в модуле не меняется
+        @wraps(handler)
+        def timed_handler(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return handler(*args, **kwargs)
+            finally:
+                handler_seconds.labels(handler.__name__).observe(time.perf_counter() - started)
+        return telebot.TeleBot._build_handler_dict(timed_handler, pass_bot, **filters)
+
+    def _outgoing(self, method, args, kwargs):
+        if self.route is not None:
+            return self.route(method, args, kwargs)
+        return getattr(telebot.TeleBot, method)(self, *args, **kwargs)
+
+# Обработчики вызываются прямо в потоках очереди обновлений (см. update_worker)
+# или в цикле событий asyncio-режима, поэтому свой пул потоков telebot не нужен
+bot = CalorieBot(TOKEN, threaded=False)
 app = Flask(__name__)
 
-# ==================== ДАННЫЕ ====================
-PRODUCTS_FILE = "products.json"
-USER_DATA_FILE = "user_data.json"
+# ==================== ИСХОДЯЩИЕ СООБЩЕНИЯ ====================
+# Все запросы бота идут через очередь outbound: лимиты Telegram (около
+# 30 сообщений в секунду на бота и 1 в секунду на чат) соблюдаются до
+# отправки, а ответ 429 приводит к повтору после retry_after.
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', 4))  # потоков-отправителей и соединений
+SEND_RATE = float(os.getenv('SEND_RATE', 30))  # запросов в секунду на бота
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', 1))  # запросов в секунду на чат
+SEND_CHAT_BURST = int(os.getenv('SEND_CHAT_BURST', 3))  # запас для коротких серий ответов
+
+# Одна сессия requests с пулом keep-alive соединений на всех отправителей
+api_session = requests.Session()
+api_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=SEND_WORKERS))
+apihelper.session = api_session
+apihelper.SESSION_TIME_TO_LIVE = None
+
+# requests собирает multipart-тело целиком в памяти, поэтому файлы выгрузки
+# отправляются своим телом запроса, которое читает файл частями
+UPLOAD_CHUNK = 64 * 1024
+
+class MultipartUpload:
+    """Тело multipart/form-data с одним файлом, читаемым частями при отправке.
+
+    Длина известна заранее, поэтому requests ставит Content-Length,
+    а не chunked-кодирование.
+    """
+
+    def __init__(self, fields, name, filename, file):
+        boundary = os.urandom(16).hex()
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        parts = [
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'
+            for key, value in fields.items()
+        ]
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'
+        )
+        self.head = "".join(parts).encode('utf-8')
+        self.tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+        self.file = file
+        self.start = file.tell()
+        self.size = file.seek(0, os.SEEK_END) - self.start
+        file.seek(self.start)
+
+    def __len__(self):
+        return len(self.head) + self.size + len(self.tail)
+
+    def __iter__(self):
+        self.file.seek(self.start)
+        yield self.head
+        while True:
+            chunk = self.file.read(UPLOAD_CHUNK)
+            if not chunk:
+                break
+            yield chunk
+        yield self.tail
+
+def send_document_streamed(chat_id, document, visible_file_name=None, reply_markup=None, **fields):
+    """sendDocument для файла на диске без загрузки его в память"""
+    fields["chat_id"] = chat_id
+    if reply_markup is not None:
+        fields["reply_markup"] = apihelper._convert_markup(reply_markup)
+    upload = MultipartUpload(
+        {key: value for key, value in fields.items() if value is not None},
+        "document", visible_file_name or "document", document,
+    )
+    response = api_session.post(
+        (apihelper.API_URL or "https://api.telegram.org/bot{0}/{1}").format(TOKEN, "sendDocument"),
+        data=upload,
+        headers={"Content-Type": upload.content_type},
+        timeout=(apihelper.CONNECT_TIMEOUT, apihelper.READ_TIMEOUT),
+    )
+    return telebot.types.Message.de_json(apihelper._check_result("sendDocument", response)["result"])
+
+def call_api(method, args, kwargs):
+    """Запрос к Bot API из потока-отправителя"""
+    if async_bot is not None:
+        # aiohttp и так читает файлы частями
+        coroutine = getattr(async_bot, method)(*args, **kwargs)
+        return asyncio.run_coroutine_threadsafe(coroutine, event_loop).result(ASYNC_CALL_TIMEOUT)
+    if method == "send_document" and hasattr(args[1], "read"):
+        return send_document_streamed(*args, **kwargs)
+    return getattr(telebot.TeleBot, method)(bot, *args, **kwargs)
+
+def outgoing_chat_id(method, args, kwargs):
+    """Чат запроса для лимитов; None — запрос не относится к чату"""
+    if method == "answer_callback_query":
+        return None
+    return kwargs["chat_id"] if "chat_id" in kwargs else args[0]
+
+def send_queued(method, args, kwargs):
+    """Отправка через очередь с ожиданием ответа API"""
+    return outbound_queue.submit(outgoing_chat_id(method, args, kwargs), method, args, kwargs).result()
+
+def log_send_error(future):
+    if future.exception() is not None:
+        logger.error(f"Ошибка отправки запроса к Bot API: {future.exception()}")
+
+def send_later(method, args, kwargs):
+    """Постановка запроса в очередь без ожидания ответа; ошибки пишутся в лог.
+
+    Так поток обработчика не простаивает, пока очередь выдерживает лимит
+    чата. Ответ API нужен немногим (file_id графика) — они вызывают send_queued.
+    """
+    future = outbound_queue.submit(outgoing_chat_id(method, args, kwargs), method, args, kwargs)
+    future.add_done_callback(log_send_error)
+
+outbound_queue = outbound.Dispatcher(
+    call_api, workers=SEND_WORKERS, rate=SEND_RATE,
+    chat_rate=SEND_CHAT_RATE, chat_burst=SEND_CHAT_BURST,
+)
+bot.route = send_later
 
+# ==================== ДАННЫЕ ====================
 def load_data():
-    """Загрузка данных из файлов"""
+    """Открытие хранилища: каталог продуктов читается сразу, пользователи — по требованию"""
     try:
-        if os.path.exists(PRODUCTS_FILE):
-            with open(PRODUCTS_FILE, 'r', encoding='utf-8') as f:
-                products = json.load(f)
-        else:
-            products = {"яблоко": 52, "курица": 165, "шоколад": 546}
-
-        if os.path.exists(USER_DATA_FILE):
-            with open(USER_DATA_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                user_data = defaultdict(
-                    lambda: {"total": 0, "history": []},
-                    {k: v if isinstance(v, dict) else {"total": v, "history": []} for k, v in data.items()}
-                )
-        else:
-            user_data = defaultdict(lambda: {"total": 0, "history": []})
-        
-        return products, user_data
+        return storage.open_storage()
     except Exception as e:
         logger.error(f"Ошибка загрузки данных: {e}")
-        return {"яблоко": 52, "курица": 165, "шоколад": 546}, defaultdict(lambda: {"total": 0, "history": []})
+        raise
+
+save_seconds = metrics.histogram_family("save_data_seconds", "Время сохранения изменения", "op")
+save_bytes = metrics.counter_family("save_data_bytes_total", "Объём сохранённых событий в JSON", "op")
 
-def save_data():
-    """Сохранение данных в файлы"""
+def save_data(op, **fields):
+    """Сохранение изменения: событие применяется к данным и пишется в журнал"""
     try:
-        with open(PRODUCTS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(products, f, ensure_ascii=False, indent=2)
-        with open(USER_DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(dict(user_data), f, ensure_ascii=False, indent=2)
+        started = time.perf_counter()
+        event = dict(op=op, **fields)
+        save_bytes.labels(op).inc(len(json.dumps(event, ensure_ascii=False).encode('utf-8')))
+        store.commit(event)
+        save_seconds.labels(op).observe(time.perf_counter() - started)
+        if op in ("entry", "entries", "reset"):
+            chart_cache.invalidate(fields["user"])
     except Exception as e:
         logger.error(f"Ошибка сохранения данных: {e}")
 
-products, user_data = load_data()
+# Открывается только каталог продуктов, пользователи загружаются при первом обращении
+with startup_phase("storage"):
+    store = load_data()
+products, user_data = store.products, store.users
+with startup_phase("state_store"):
+    conversations = storage.open_state_store()
 
-# ==================== ГРАФИКИ ====================
-def generate_week_plot(user_id):
-    """Генерация графика за неделю"""
-    try:
-        user_stats = user_data.get(str(user_id), {})
-        history = user_stats.get("history", [])
-        daily_calories = defaultdict(int)
-        
-        for entry in history:
-            date = entry["date"]
-            daily_calories[date] += entry["calories"]
-        
-        if not daily_calories:
+# ==================== ЧАСОВЫЕ ПОЯСА ====================
+# Записи датируются по местному дню пользователя. Калории за день берутся
+# из итогов daily[дата], поэтому новый день начинается сам собой при первом
+# обращении — без обхода всех пользователей по расписанию.
+DEFAULT_TZ = os.getenv('DEFAULT_TZ', '')  # пусто — время сервера
+TZ_OFFSET_RE = re.compile(r'^(?:UTC|GMT)?\s*([+-])(\d{1,2})(?::?(\d{2}))?$', re.IGNORECASE)
+
+@lru_cache(maxsize=256)
+def parse_timezone(name):
+    """Часовой пояс из строки 'Europe/Moscow', '+3' или 'UTC+05:30'; None, если не распознан"""
+    match = TZ_OFFSET_RE.match(name.strip())
+    if match:
+        sign, hours, minutes = match.groups()
+        offset = timedelta(hours=int(hours), minutes=int(minutes or 0))
+        if offset > timedelta(hours=14):
             return None
-        
-        dates = sorted(daily_calories.keys())[-7:]  # Последние 7 дней
-        calories = [daily_calories[date] for date in dates]
-        
-        plt.figure(figsize=(10, 5))
-        plt.plot(dates, calories, marker='o', linestyle='-', color='teal')
-        plt.title("Калории за неделю")
-        plt.xlabel("Дата")
-        plt.ylabel("Ккал")
-        plt.grid(True)
-        plt.tight_layout()
-        
-        buffer = BytesIO()
-        plt.savefig(buffer, format='png', dpi=80)
-        buffer.seek(0)
-        plt.close()
-        return buffer
-    except Exception as e:
-        logger.error(f"Ошибка генерации графика: {e}")
+        return timezone(-offset if sign == '-' else offset)
+    try:
+        return ZoneInfo(name.strip())
+    except (ZoneInfoNotFoundError, ValueError):  # неизвестное или недопустимое название
         return None
 
-def generate_pie_chart(user_id):
-    """Генерация круговой диаграммы"""
-    try:
-        user_stats = user_data.get(str(user_id), {})
-        history = user_stats.get("history", [])
-        
-        if not history:
-            return None
-        
-        product_calories = defaultdict(int)
-        for entry in history:
-            product_calories[entry["product"]] += entry["calories"]
-        
-        top_products = dict(sorted(product_calories.items(), key=lambda x: x[1], reverse=True)[:5])
-        
-        plt.figure(figsize=(8, 8))
-        plt.pie(
-            top_products.values(),
-            labels=top_products.keys(),
-            autopct='%1.1f%%',
-            startangle=90
-        )
-        plt.title("Топ продуктов по калориям")
-        
-        buffer = BytesIO()
-        plt.savefig(buffer, format='png', dpi=80)
-        buffer.seek(0)
-        plt.close()
-        return buffer
-    except Exception as e:
-        logger.error(f"Ошибка генерации диаграммы: {e}")
+def local_today(user_id):
+    """Сегодняшняя дата '%Y-%m-%d' в часовом поясе пользователя"""
+    name = user_data.get(str(user_id), {}).get("tz") or DEFAULT_TZ
+    tz = parse_timezone(name) if name else None
+    return datetime.now(tz).strftime("%Y-%m-%d")
+
+def today_calories(user_id):
+    """Калории за сегодняшний местный день"""
+    user_id = str(user_id)
+    daily = user_data.get(user_id, {}).get("daily", {})
+    return daily.get(local_today(user_id), 0)
+
+# Поисковый индекс продуктов вместе с версией каталога, по которой он построен
+catalog_state = (None, catalog.Catalog())
+
+def product_catalog():
+    """Индекс продуктов; перестраивается после изменения каталога"""
+    global catalog_state
+    revision, index = catalog_state
+    if revision != store.products_revision:
+        revision = store.products_revision
+        index = catalog.Catalog(list(products))
+        catalog_state = (revision, index)
+    return index
+
+# ==================== ГРАФИКИ ====================
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', 2))
+CHART_QUEUE_LIMIT = int(os.getenv('CHART_QUEUE_LIMIT', 8))  # графиков в работе одновременно
+CHART_TIMEOUT = float(os.getenv('CHART_TIMEOUT', 20))  # секунд на один график
+
+chart_pool = None
+chart_pool_lock = threading.Lock()
+chart_slots = threading.BoundedSemaphore(CHART_QUEUE_LIMIT)
+# Готовые графики отправляются отсюда, чтобы не занимать служебный поток пула процессов
+reply_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="chart-reply")
+
+def chart_context():
+    """forkserver: процессы пула порождаются из отдельного однопоточного процесса.
+
+    fork прямо из бота копировал бы процесс с уже запущенными потоками
+    (очереди обновлений, отправка, запись данных) и их блокировками.
+    Сервер заранее загружает только charts и matplotlib, а не bot.py.
+    """
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(['charts', 'matplotlib.figure', 'matplotlib.backends.backend_agg'])
+    return context
+
+def get_chart_pool(broken=None):
+    """Пул процессов отрисовки: создаётся при первом графике и пересоздаётся после сбоя"""
+    global chart_pool
+    with chart_pool_lock:
+        if chart_pool is None or chart_pool is broken:
+            chart_pool = ProcessPoolExecutor(
+                max_workers=CHART_WORKERS,
+                mp_context=chart_context(),
+                initializer=charts.preload
+            )
+        return chart_pool
+
+def recycle_chart_pool(pool):
+    """Замена пула после зависшей отрисовки.
+
+    Процессы старого пула завершаются, его задачи получают BrokenProcessPool:
+    так освобождаются и процессы, и места chart_slots зависших графиков.
+    """
+    get_chart_pool(broken=pool)
+    # Публичного способа остановить процессы у ProcessPoolExecutor нет (до Python 3.14)
+    for process in list((pool._processes or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False)
+
+def week_plot_data(user_id):
+    """Данные графика за неделю: (даты, калории) или None"""
+    user_stats = user_data.get(str(user_id), {})
+    daily_calories = user_stats.get("daily", {})
+    if not daily_calories:
+        return None
+    # Дни добавляются в хронологическом порядке — берём 7 последних с конца
+    dates = sorted(islice(reversed(daily_calories), 7))
+    return dates, [daily_calories[date] for date in dates]
+
+def pie_chart_data(user_id):
+    """Данные круговой диаграммы: (продукты, калории) или None"""
+    user_stats = user_data.get(str(user_id), {})
+    product_calories = user_stats.get("by_product", {})
+    if not product_calories:
         return None
+    top_products = heapq.nlargest(5, product_calories.items(), key=lambda x: x[1])
+    return [name for name, _ in top_products], [kcal for _, kcal in top_products]
+
+CHART_RENDERERS = {
+    "week": charts.render_week_plot,
+    "pie": charts.render_pie_chart,
+}
+
+chart_cache_hits = metrics.counter("chart_cache_hits_total", "График отправлен из кэша")
+chart_cache_misses = metrics.counter("chart_cache_misses_total", "График пришлось отрисовать")
+chart_render_seconds = metrics.histogram_family(
+    "chart_render_seconds", "Время построения графика в пуле процессов (с ожиданием)", "kind",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30),
+)
+
+class ChartCache:
+    """Кэш готовых графиков по хэшу входных данных.
+
+    Хранит PNG в LRU с ограничением по суммарному размеру и file_id, который
+    Telegram вернул при первой отправке: повторный показ того же графика
+    уходит по file_id без отрисовки и без повторной загрузки файла.
+    """
+
+    ENTRY_OVERHEAD = 256  # примерный размер записи без PNG
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # ключ -> [png, file_id]
+        self.size = 0
+        self.by_user = defaultdict(set)
+
+    @staticmethod
+    def key(kind, data):
+        payload = json.dumps([kind, data], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, user_id, key):
+        """(png, file_id) или None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            self.by_user[user_id].add(key)
+            return tuple(entry)
+
+    def put(self, user_id, key, png=None, file_id=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = [None, None]
+                self.size += self.ENTRY_OVERHEAD
+            if png is not None and entry[0] is None:
+                entry[0] = png
+                self.size += len(png)
+            if file_id is not None:
+                entry[1] = file_id
+            self.entries.move_to_end(key)
+            self.by_user[user_id].add(key)
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                self._drop(next(iter(self.entries)))
+
+    def forget(self, key):
+        with self.lock:
+            self._drop(key)
+
+    def invalidate(self, user_id):
+        """Сброс графиков пользователя после новой записи или сброса данных"""
+        with self.lock:
+            for key in self.by_user.pop(user_id, ()):
+                self._drop(key)
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= self.ENTRY_OVERHEAD + len(entry[0] or b"")
+
+chart_cache = ChartCache(int(os.getenv('CHART_CACHE_BYTES', 20 * 1024 * 1024)))
+
+def send_cached_chart(chat_id, key, cached, caption, on_failure):
+    """Отправка графика из кэша без ожидания ответа.
+
+    Если отправить не удалось (например, file_id устарел), запись кэша
+    удаляется и вызывается on_failure.
+    """
+    png, file_id = cached
+
+    def sent(done):
+        if done.exception() is None:
+            chart_cache_hits.inc()
+            return
+        logger.warning(f"Не удалось отправить график из кэша: {done.exception()}")
+        chart_cache.forget(key)
+        try:
+            on_failure()
+        except Exception as e:
+            logger.error(f"Ошибка повторной отправки графика: {e}")
+
+    outbound_queue.submit(
+        chat_id, "send_photo", (chat_id, file_id or BytesIO(png)),
+        dict(caption=caption, reply_markup=create_keyboard()),
+    ).add_done_callback(sent)
+
+def submit_chart(chat_id, kind, data, caption, error_text):
+    """Отправка графика из кэша или отрисовка в пуле процессов с отправкой по готовности.
+
+    Возвращает False, если в работе уже CHART_QUEUE_LIMIT графиков.
+    Если отрисовка не уложилась в CHART_TIMEOUT, пользователь получает
+    error_text, а пул с зависшим процессом заменяется новым.
+    """
+    user_id = str(chat_id)
+    key = ChartCache.key(kind, data)
+    cached = chart_cache.get(user_id, key)
+    if cached:
+        def render_again():
+            if not submit_chart(chat_id, kind, data, caption, error_text):
+                bot.send_message(chat_id, error_text, reply_markup=create_keyboard())
+        send_cached_chart(chat_id, key, cached, caption, render_again)
+        return True
+    chart_cache_misses.inc()
+
+    if not chart_slots.acquire(blocking=False):
+        return False
+    render = CHART_RENDERERS[kind]
+    started = time.perf_counter()
+    try:
+        pool = get_chart_pool()
+        try:
+            future = pool.submit(render, *data)
+        except BrokenProcessPool:
+            pool = get_chart_pool(broken=pool)
+            future = pool.submit(render, *data)
+    except Exception:
+        chart_slots.release()
+        raise
+
+    answered = threading.Lock()  # первый из ответов (график или таймаут) захватывает навсегда
+
+    def reply(done=None):
+        if not answered.acquire(blocking=False):
+            return
+        try:
+            if done is not None and done.exception() is None:
+                png = done.result()
+                chart_cache.put(user_id, key, png=png)
+                # Ответ API нужен ради file_id, поэтому здесь отправка с ожиданием
+                sent = send_queued("send_photo", (chat_id, BytesIO(png)),
+                                   dict(caption=caption, reply_markup=create_keyboard()))
+                if sent and sent.photo:
+                    chart_cache.put(user_id, key, file_id=sent.photo[-1].file_id)
+                return
+            if done is None:
+                logger.warning(f"График для {chat_id} не построен за {CHART_TIMEOUT} с, пул пересоздаётся")
+                recycle_chart_pool(pool)
+            else:
+                logger.error(f"Ошибка генерации графика: {done.exception()}")
+            bot.send_message(chat_id, error_text, reply_markup=create_keyboard())
+        except Exception as e:
+            logger.error(f"Ошибка отправки графика: {e}")
+
+    timer = threading.Timer(CHART_TIMEOUT, reply)
+    timer.daemon = True
+    timer.start()
+
+    def on_done(done):
+        chart_render_seconds.labels(kind).observe(time.perf_counter() - started)
+        chart_slots.release()
+        timer.cancel()
+        reply_pool.submit(reply, done)
+
+    future.add_done_callback(on_done)
+    return True
 
 # ==================== КЛАВИАТУРЫ ====================
-def back_to_menu_keyboard():
-    """Клавиатура для возврата в меню"""
+KEYBOARD_PRODUCTS = int(os.getenv('KEYBOARD_PRODUCTS', 20))  # кнопок продуктов на одной странице
+MORE_PRODUCTS = "➡️ Ещё продукты"
+
+class CachedMarkup(JsonSerializable):
+    """Клавиатура, сериализованная один раз: telebot берёт готовую строку из to_json()"""
+
+    def __init__(self, markup):
+        self.json = markup.to_json()
+
+    def to_json(self):
+        return self.json
+
+def _back_to_menu_markup():
     markup = ReplyKeyboardMarkup(resize_keyboard=True)
     markup.add("🏠 Главное меню")
+    return CachedMarkup(markup)
+
+BACK_TO_MENU_MARKUP = _back_to_menu_markup()
+
+def back_to_menu_keyboard():
+    """Клавиатура для возврата в меню"""
+    return BACK_TO_MENU_MARKUP
+
+# Готовые клавиатуры по номеру страницы; сбрасываются при изменении каталога
+keyboard_cache = {}
+keyboard_revision = None
+
+def products_page_count():
+    return max(1, -(-len(products) // KEYBOARD_PRODUCTS))
+
+def create_keyboard(page=0):
+    """Основная клавиатура; кэшируется до следующего изменения списка продуктов"""
+    global keyboard_cache, keyboard_revision
+    if keyboard_revision != store.products_revision:
+        keyboard_cache, keyboard_revision = {}, store.products_revision
+    markup = keyboard_cache.get(page)
+    if markup is None:
+        markup = keyboard_cache[page] = CachedMarkup(build_keyboard(page))
     return markup
 
-def create_keyboard():
-    """Основная клавиатура"""
+def remove_keyboard():
+    """Клавиатура удаления: не больше KEYBOARD_PRODUCTS продуктов, остальные вводятся текстом"""
+    create_keyboard()  # сверка версии кэша
+    markup = keyboard_cache.get("remove")
+    if markup is None:
+        markup = ReplyKeyboardMarkup(resize_keyboard=True)
+        for product in islice(products.keys(), KEYBOARD_PRODUCTS):
+            markup.add(product)
+        markup.add("🏠 Главное меню")
+        markup = keyboard_cache["remove"] = CachedMarkup(markup)
+    return markup
+
+def build_keyboard(page):
     markup = ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-    buttons = list(products.keys())
+    start = page * KEYBOARD_PRODUCTS
+    buttons = list(islice(products.keys(), start, start + KEYBOARD_PRODUCTS))
     markup.add(*buttons)
+    pages = products_page_count()
+    if pages > 1:
+        markup.row(f"{MORE_PRODUCTS} ({(page + 1) % pages + 1}/{pages})")
     markup.row("📊 Итог", "🔄 Сбросить")
     markup.row("➕ Добавить продукт", "❌ Удалить продукт")
     markup.row("📈 График за неделю", "🥧 Топ продуктов")
@@ -160,9 +630,9 @@ def start(message):
     """Обработчик стартового сообщения"""
     try:
         user_id = str(message.chat.id)
+        conversations.clear(user_id)
         if user_id not in user_data:
-            user_data[user_id] = {"total": 0, "history": []}
-            save_data()
+            save_data("user", user=user_id)
         
         bot.send_message(
             message.chat.id,
@@ -173,44 +643,49 @@ def start(message):
         logger.error(f"Ошибка в start: {e}")
         bot.send_message(message.chat.id, "⚠️ Произошла ошибка. Попробуйте позже.")
 
-@bot.message_handler(func=lambda m: m.text in products.keys())
-def add_product(message):
+def add_product(message, product=None):
     """Добавление продукта из списка"""
     try:
-        product = message.text
-        msg = bot.send_message(
+        product = product or message.text
+        bot.send_message(
             message.chat.id,
             f"Введите количество продукта '{product}' в граммах:",
             reply_markup=back_to_menu_keyboard()
         )
-        bot.register_next_step_handler(msg, lambda m: process_product_amount(m, product))
+        conversations.set(message.chat.id, {"step": "amount", "product": product})
     except Exception as e:
         logger.error(f"Ошибка в add_product: {e}")
         bot.send_message(message.chat.id, "⚠️ Ошибка обработки продукта", reply_markup=create_keyboard())
 
+# Пределы ввода: записи истории хранятся в int32, а больше и не бывает
+MAX_AMOUNT = 100000  # граммов в одной записи
+MAX_KCAL = 1000  # ккал на 100 г (у чистого жира около 900)
+
 def process_product_amount(message, product):
     """Обработка количества продукта"""
     try:
         amount = int(message.text)
+        if not 0 < amount <= MAX_AMOUNT:
+            bot.send_message(
+                message.chat.id,
+                f"❌ Количество должно быть от 1 до {MAX_AMOUNT} г",
+                reply_markup=create_keyboard()
+            )
+            return
         calories = int(products[product] * amount / 100)
         user_id = str(message.chat.id)
         
-        if user_id not in user_data:
-            user_data[user_id] = {"total": 0, "history": []}
-        
-        user_data[user_id]["total"] += calories
-        user_data[user_id]["history"].append({
+        save_data("entry", user=user_id, entry={
             "product": product,
             "amount": amount,
             "calories": calories,
-            "date": datetime.now().strftime("%Y-%m-%d")
+            "date": local_today(user_id)
         })
-        save_data()
         
         bot.send_message(
             message.chat.id,
             f"✅ Добавлено: {product} - {amount}г ({calories} ккал)\n"
-            f"Всего сегодня: {user_data[user_id]['total']} ккал",
+            f"Всего сегодня: {today_calories(user_id)} ккал",
             reply_markup=create_keyboard()
         )
     except ValueError:
@@ -223,28 +698,90 @@ def process_product_amount(message, product):
         logger.error(f"Ошибка в process_product_amount: {e}")
         bot.send_message(message.chat.id, "⚠️ Ошибка обработки количества", reply_markup=create_keyboard())
 
-@bot.message_handler(func=lambda m: m.text == "📊 Итог")
+# Приём пищи одним сообщением: «курица 200, яблоко 150, шоколад 30»
+MEAL_SEPARATORS_RE = re.compile(r'[,;\n]+')
+# Двоеточие в названии — это формат добавления продукта «Банан:95», а не приём пищи
+MEAL_ITEM_RE = re.compile(r'^([^:]*?[^\d:])\s*(\d+)\s*(?:г|гр|g)?\.?$', re.IGNORECASE)
+
+def parse_meal(text):
+    """Список (название, граммы) или None, если текст не похож на приём пищи"""
+    items = []
+    for part in MEAL_SEPARATORS_RE.split(text):
+        part = part.strip()
+        if not part:
+            continue
+        match = MEAL_ITEM_RE.match(part)
+        if not match or not match.group(1).strip():
+            return None
+        items.append((match.group(1).strip(), int(match.group(2))))
+    return items or None
+
+def process_meal(message, items):
+    """Запись нескольких продуктов одним событием и одним ответом"""
+    try:
+        index = product_catalog()
+        entries, unknown = [], []
+        date = local_today(message.chat.id)
+        for text, amount in items:
+            # Записываются только точные совпадения: похожий продукт легко
+            # оказался бы другим («сок» -> «сок яблочный»), поэтому он лишь подсказка
+            product = index.lookup(text)
+            if product is None:
+                similar = index.search(text, limit=3)
+                unknown.append(f"{text} (возможно: {', '.join(similar)})" if similar else text)
+                continue
+            if not 0 < amount <= MAX_AMOUNT:
+                unknown.append(f"{text} {amount}")
+                continue
+            entries.append({
+                "product": product,
+                "amount": amount,
+                "calories": int(products[product] * amount / 100),
+                "date": date
+            })
+        if unknown:
+            # Всё или ничего: частично записанный приём пищи легко не заметить
+            bot.send_message(
+                message.chat.id,
+                "❌ Не удалось разобрать:\n" + "\n".join(f"• {item}" for item in unknown) + "\n"
+                "Ничего не записано. Формат: курица 200, яблоко 150",
+                reply_markup=create_keyboard()
+            )
+            return
+        user_id = str(message.chat.id)
+        save_data("entries", user=user_id, entries=entries)
+        lines = [f"• {e['product']} - {e['amount']}г ({e['calories']} ккал)" for e in entries]
+        bot.send_message(
+            message.chat.id,
+            "✅ Добавлено:\n" + "\n".join(lines) + "\n"
+            f"Итого: {sum(e['calories'] for e in entries)} ккал\n"
+            f"Всего сегодня: {today_calories(user_id)} ккал",
+            reply_markup=create_keyboard()
+        )
+    except Exception as e:
+        logger.error(f"Ошибка в process_meal: {e}")
+        bot.send_message(message.chat.id, "⚠️ Ошибка записи приёма пищи", reply_markup=create_keyboard())
+
 def show_total(message):
-    """Показать общее количество калорий"""
+    """Показать калории за сегодня и за всё время"""
     try:
         user_id = str(message.chat.id)
         total = user_data.get(user_id, {}).get("total", 0)
         bot.send_message(
             message.chat.id,
-            f"📊 Всего потреблено калорий: {total} ккал",
+            f"📊 Сегодня: {today_calories(user_id)} ккал\n"
+            f"Всего потреблено калорий: {total} ккал",
             reply_markup=create_keyboard()
         )
     except Exception as e:
         logger.error(f"Ошибка в show_total: {e}")
         bot.send_message(message.chat.id, "⚠️ Ошибка получения данных", reply_markup=create_keyboard())
 
-@bot.message_handler(func=lambda m: m.text == "🔄 Сбросить")
 def reset_counter(message):
     """Сброс данных пользователя"""
     try:
         user_id = str(message.chat.id)
-        user_data[user_id] = {"total": 0, "history": []}
-        save_data()
+        save_data("reset", user=user_id)
         bot.send_message(
             message.chat.id,
             "🔄 Данные сброшены!",
@@ -254,66 +791,104 @@ def reset_counter(message):
         logger.error(f"Ошибка в reset_counter: {e}")
         bot.send_message(message.chat.id, "⚠️ Ошибка сброса данных", reply_markup=create_keyboard())
 
-@bot.message_handler(func=lambda m: m.text == "📈 График за неделю")
-def send_week_plot(message):
-    """Отправка графика за неделю"""
+@bot.message_handler(commands=['timezone'])
+def set_timezone(message):
+    """Настройка часового пояса: /timezone Europe/Moscow или /timezone +3"""
     try:
-        plot = generate_week_plot(message.chat.id)
-        if plot:
-            bot.send_photo(
+        user_id = str(message.chat.id)
+        parts = message.text.split(maxsplit=1)
+        if len(parts) < 2:
+            current = user_data.get(user_id, {}).get("tz") or DEFAULT_TZ or "время сервера"
+            bot.send_message(
                 message.chat.id,
-                plot,
-                caption="📈 Ваша статистика за неделю",
+                f"🕒 Часовой пояс: {current}\n"
+                "Чтобы изменить, отправьте, например:\n/timezone Europe/Moscow\n/timezone +3",
                 reply_markup=create_keyboard()
             )
-        else:
+            return
+        if parse_timezone(parts[1]) is None:
+            bot.send_message(
+                message.chat.id,
+                "❌ Не удалось распознать часовой пояс. Пример: Europe/Moscow или +3",
+                reply_markup=create_keyboard()
+            )
+            return
+        save_data("tz", user=user_id, tz=parts[1].strip())
+        bot.send_message(
+            message.chat.id,
+            f"✅ Часовой пояс: {parts[1].strip()}, сейчас там {local_today(user_id)}",
+            reply_markup=create_keyboard()
+        )
+    except Exception as e:
+        logger.error(f"Ошибка в set_timezone: {e}")
+        bot.send_message(message.chat.id, "⚠️ Ошибка настройки часового пояса", reply_markup=create_keyboard())
+
+CHARTS_BUSY_TEXT = "⏳ Сейчас строится слишком много графиков, попробуйте через минуту"
+
+def send_week_plot(message):
+    """Отправка графика за неделю"""
+    try:
+        data = week_plot_data(message.chat.id)
+        if not data:
             bot.send_message(
                 message.chat.id,
                 "❌ Нет данных для построения графика",
                 reply_markup=create_keyboard()
             )
+        elif not submit_chart(message.chat.id, "week", data,
+                              "📈 Ваша статистика за неделю", "⚠️ Ошибка генерации графика"):
+            bot.send_message(message.chat.id, CHARTS_BUSY_TEXT, reply_markup=create_keyboard())
     except Exception as e:
         logger.error(f"Ошибка в send_week_plot: {e}")
         bot.send_message(message.chat.id, "⚠️ Ошибка генерации графика", reply_markup=create_keyboard())
 
-@bot.message_handler(func=lambda m: m.text == "🥧 Топ продуктов")
 def send_pie_chart(message):
     """Отправка круговой диаграммы"""
     try:
-        chart = generate_pie_chart(message.chat.id)
-        if chart:
-            bot.send_photo(
-                message.chat.id,
-                chart,
-                caption="🥧 Топ потребляемых продуктов",
-                reply_markup=create_keyboard()
-            )
-        else:
+        data = pie_chart_data(message.chat.id)
+        if not data:
             bot.send_message(
                 message.chat.id,
                 "❌ Нет данных для построения графика",
                 reply_markup=create_keyboard()
             )
+        elif not submit_chart(message.chat.id, "pie", data,
+                              "🥧 Топ потребляемых продуктов", "⚠️ Ошибка генерации диаграммы"):
+            bot.send_message(message.chat.id, CHARTS_BUSY_TEXT, reply_markup=create_keyboard())
     except Exception as e:
         logger.error(f"Ошибка в send_pie_chart: {e}")
         bot.send_message(message.chat.id, "⚠️ Ошибка генерации диаграммы", reply_markup=create_keyboard())
 
-@bot.message_handler(func=lambda m: m.text == "➕ Добавить продукт")
 def add_new_product(message):
     """Добавление нового продукта"""
     try:
-        msg = bot.send_message(
+        bot.send_message(
             message.chat.id,
             "Введите название продукта и калорийность в формате:\n"
             "Название:калорийность_на_100г\n"
             "Пример: Банан:95",
             reply_markup=back_to_menu_keyboard()
         )
-        bot.register_next_step_handler(msg, process_add_product)
+        conversations.set(message.chat.id, {"step": "add_product"})
     except Exception as e:
         logger.error(f"Ошибка в add_new_product: {e}")
         bot.send_message(message.chat.id, "⚠️ Ошибка добавления продукта", reply_markup=create_keyboard())
-@bot.message_handler(func=lambda m: m.text == "🏠 Главное меню")
+def more_products(message):
+    """Следующая страница продуктов на клавиатуре"""
+    try:
+        match = re.search(r"\((\d+)/\d+\)", message.text)
+        page = int(match.group(1)) - 1 if match else 0
+        if not 0 <= page < products_page_count():
+            page = 0
+        bot.send_message(
+            message.chat.id,
+            f"Продукты, страница {page + 1}/{products_page_count()}:",
+            reply_markup=create_keyboard(page)
+        )
+    except Exception as e:
+        logger.error(f"Ошибка в more_products: {e}")
+        bot.send_message(message.chat.id, "⚠️ Ошибка получения данных", reply_markup=create_keyboard())
+
 def main_menu(message):
     try:
         bot.send_message(
@@ -332,21 +907,29 @@ def process_add_product(message):
         name, kcal = message.text.split(":")
         name = name.strip().lower()
         kcal = int(kcal.strip())
+        if not 0 <= kcal <= MAX_KCAL:
+            bot.send_message(
+                message.chat.id,
+                f"❌ Калорийность должна быть от 0 до {MAX_KCAL} ккал/100г",
+                reply_markup=create_keyboard()
+            )
+            return
         
-        if name in products:
+        existing = product_catalog().lookup(name)
+        if existing is not None:
+            name = existing
             confirm_markup = ReplyKeyboardMarkup(resize_keyboard=True)
             confirm_markup.add("Да", "Нет", "🏠 Главное меню")
-            msg = bot.send_message(
+            bot.send_message(
                 message.chat.id,
                 f"⚠️ Продукт '{name}' уже есть!\n"
                 f"Текущая калорийность: {products[name]} ккал\n"
                 "Заменить? (Да/Нет)",
                 reply_markup=confirm_markup
             )
-            bot.register_next_step_handler(msg, lambda m: confirm_replace(m, name, kcal))
+            conversations.set(message.chat.id, {"step": "confirm_replace", "name": name, "kcal": kcal})
         else:
-            products[name] = kcal
-            save_data()
+            save_data("product", name=name, kcal=kcal)
             bot.send_message(
                 message.chat.id,
                 f"✅ '{name}' ({kcal} ккал/100г) добавлен!",
@@ -366,8 +949,7 @@ def confirm_replace(message, name, kcal):
     """Подтверждение замены продукта"""
     try:
         if message.text.lower() == "да":
-            products[name] = kcal
-            save_data()
+            save_data("product", name=name, kcal=kcal)
             bot.send_message(
                 message.chat.id,
                 f"✅ '{name}' обновлён! Новая калорийность: {kcal} ккал/100г",
@@ -383,7 +965,6 @@ def confirm_replace(message, name, kcal):
         logger.error(f"Ошибка в confirm_replace: {e}")
         bot.send_message(message.chat.id, "⚠️ Ошибка подтверждения", reply_markup=create_keyboard())
 
-@bot.message_handler(func=lambda m: m.text == "❌ Удалить продукт")
 def remove_product_start(message):
     """Начало удаления продукта"""
     try:
@@ -391,17 +972,15 @@ def remove_product_start(message):
             bot.send_message(message.chat.id, "Список продуктов пуст", reply_markup=create_keyboard())
             return
             
-        markup = ReplyKeyboardMarkup(resize_keyboard=True)
-        for product in products.keys():
-            markup.add(product)
-        markup.add("🏠 Главное меню")
-        
-        msg = bot.send_message(
+        text = "Выберите продукт для удаления:"
+        if len(products) > KEYBOARD_PRODUCTS:
+            text = "Выберите продукт для удаления или введите его название:"
+        bot.send_message(
             message.chat.id,
-            "Выберите продукт для удаления:",
-            reply_markup=markup
+            text,
+            reply_markup=remove_keyboard()
         )
-        bot.register_next_step_handler(msg, process_remove_product)
+        conversations.set(message.chat.id, {"step": "remove_product"})
     except Exception as e:
         logger.error(f"Ошибка в remove_product_start: {e}")
         bot.send_message(message.chat.id, "⚠️ Ошибка удаления продукта", reply_markup=create_keyboard())
@@ -413,9 +992,9 @@ def process_remove_product(message):
         if product == "🏠 Главное меню":
             return start(message)
             
-        if product in products:
-            del products[product]
-            save_data()
+        product = product_catalog().lookup(product)
+        if product is not None:
+            save_data("product_del", name=product)
             bot.send_message(
                 message.chat.id,
                 f"✅ Продукт '{product}' удалён!",
@@ -431,51 +1010,166 @@ def process_remove_product(message):
         logger.error(f"Ошибка в process_remove_product: {e}")
         bot.send_message(message.chat.id, "⚠️ Ошибка удаления", reply_markup=create_keyboard())
 
-@bot.message_handler(func=lambda m: m.text == "📜 История")
+HISTORY_PAGE = 10  # записей на странице истории
+HISTORY_CURSOR = "hist:"  # callback_data кнопок листания: hist:<нумерация>:<конец страницы>
+
+def history_numbering(user):
+    """Нумерация записей истории: меняется при сбросе и при свёртке старых записей в архив"""
+    return f"{user.get('resets', 0)}.{user.get('rolled_before', 0)}"
+
+def history_page(user_id, cursor=None):
+    """Страница истории по курсору из кнопки: (текст, кнопки) или None.
+
+    Курсор — номер записи, перед которой заканчивается страница. Новые записи
+    добавляются в конец и номера не сдвигают, а сброс и свёртка сдвигают:
+    курсор со старой нумерацией открывает последнюю страницу.
+    """
+    user = user_data.get(user_id) or {}
+    history = user.get("history", [])
+    if not history:
+        return None
+    numbering = history_numbering(user)
+    total, end = len(history), None
+    if cursor:
+        cursor_numbering, _, position = cursor.rpartition(":")
+        if cursor_numbering == numbering:
+            end = int(position)
+    end = total if end is None else max(min(end, total), min(HISTORY_PAGE, total))
+    start = max(0, end - HISTORY_PAGE)
+    lines = [f"📜 История потребления ({start + 1}–{end} из {total}):\n"]
+    for entry in history[start:end]:
+        lines.append(
+            f"📅 {entry['date']}\n"
+            f"🍏 {entry['product']}: {entry['amount']}г ({entry['calories']} ккал)\n"
+        )
+    buttons = []
+    if start > 0:
+        buttons.append(InlineKeyboardButton("⬅️ Раньше", callback_data=f"{HISTORY_CURSOR}{numbering}:{start}"))
+    if end < total:
+        buttons.append(InlineKeyboardButton("Позже ➡️", callback_data=f"{HISTORY_CURSOR}{numbering}:{min(end + HISTORY_PAGE, total)}"))
+    markup = InlineKeyboardMarkup()
+    if buttons:
+        markup.row(*buttons)
+    return "\n".join(lines), markup
+
 def show_history(message):
-    """Показать историю потребления"""
+    """Показать последние записи истории с кнопками листания"""
     try:
-        user_id = str(message.chat.id)
-        history = user_data.get(user_id, {}).get("history", [])
-        
-        if not history:
+        page = history_page(str(message.chat.id))
+        if page is None:
             bot.send_message(
                 message.chat.id,
                 "История пуста",
                 reply_markup=create_keyboard()
             )
             return
-            
-        response = "📜 История потребления:\n\n"
-        for entry in history[-10:]:  # Последние 10 записей
-            response += (
-                f"📅 {entry['date']}\n"
-                f"🍏 {entry['product']}: {entry['amount']}г ({entry['calories']} ккал)\n\n"
-            )
-        
-        bot.send_message(
-            message.chat.id,
-            response,
-            reply_markup=create_keyboard()
-        )
+        text, markup = page
+        bot.send_message(message.chat.id, text, reply_markup=markup)
     except Exception as e:
         logger.error(f"Ошибка в show_history: {e}")
         bot.send_message(message.chat.id, "⚠️ Ошибка получения истории", reply_markup=create_keyboard())
 
-@bot.message_handler(func=lambda m: m.text == "❓ Помощь")
+@bot.callback_query_handler(func=lambda call: (call.data or "").startswith(HISTORY_CURSOR))
+def turn_history_page(call):
+    """Листание истории кнопками под сообщением"""
+    try:
+        page = history_page(str(call.message.chat.id), call.data[len(HISTORY_CURSOR):])
+        if page is not None:
+            text, markup = page
+            bot.edit_message_text(
+                text,
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                reply_markup=markup
+            )
+        bot.answer_callback_query(call.id)
+    except Exception as e:
+        logger.error(f"Ошибка в turn_history_page: {e}")
+        bot.answer_callback_query(call.id, "⚠️ Ошибка получения истории")
+
+# Выгрузка: записи идут генератором из хранилища через форматер во временный
+# файл, так что в памяти никогда не оказывается вся история целиком
+EXPORT_FIELDS = ("date", "product", "amount", "calories")
+
+def csv_lines(entries):
+    """Строки CSV с заголовком, по одной"""
+    line = StringIO()
+    writer = csv.writer(line)
+    rows = chain([EXPORT_FIELDS], ([entry[field] for field in EXPORT_FIELDS] for entry in entries))
+    for row in rows:
+        writer.writerow(row)
+        yield line.getvalue()
+        line.seek(0)
+        line.truncate()
+
+def json_chunks(entries):
+    """Массив JSON по одной записи"""
+    yield "["
+    for i, entry in enumerate(entries):
+        yield ("," if i else "") + "\n" + json.dumps(entry, ensure_ascii=False)
+    yield "\n]\n"
+
+EXPORT_WRITERS = {"csv": csv_lines, "json": json_chunks}
+
+def spool(chunks):
+    """Поток строк во временный файл, готовый к отправке с начала"""
+    export_file = tempfile.TemporaryFile()
+    for chunk in chunks:
+        export_file.write(chunk.encode('utf-8'))
+    export_file.seek(0)
+    return export_file
+
+@bot.message_handler(commands=['export'])
+def export_command(message):
+    """Выгрузка всей истории файлом: /export (CSV) или /export json"""
+    try:
+        user_id = str(message.chat.id)
+        parts = message.text.split()
+        fmt = parts[1].lower() if len(parts) > 1 else "csv"
+        if fmt not in EXPORT_WRITERS:
+            bot.send_message(message.chat.id, "❌ Формат: /export csv или /export json", reply_markup=create_keyboard())
+            return
+        entries = store.export_history(user_id)
+        first = next(entries, None)
+        if first is None:
+            bot.send_message(message.chat.id, "История пуста", reply_markup=create_keyboard())
+            return
+        export_file = spool(EXPORT_WRITERS[fmt](chain([first], entries)))
+
+        def sent(done):
+            # Временный файл удаляется при закрытии, когда отправка завершена
+            export_file.close()
+            if done.exception() is not None:
+                logger.error(f"Ошибка отправки выгрузки: {done.exception()}")
+
+        # В очередь напрямую, а не через bot.send_document: файл нужно закрыть
+        # после ответа API, в том числе в asyncio-режиме
+        outbound_queue.submit(
+            message.chat.id, "send_document", (message.chat.id, export_file),
+            dict(visible_file_name=f"history.{fmt}", caption="📤 Вся история потребления",
+                 reply_markup=create_keyboard()),
+            priority=outbound.BULK,
+        ).add_done_callback(sent)
+    except Exception as e:
+        logger.error(f"Ошибка в export_command: {e}")
+        bot.send_message(message.chat.id, "⚠️ Ошибка выгрузки истории", reply_markup=create_keyboard())
+
 def show_help(message):
     """Показать справку"""
     help_text = (
         "🍎 Помощь по боту-калькулятору калорий:\n\n"
         "1. Выберите продукт из списка и укажите количество в граммах\n"
+        "   или отправьте сразу несколько: курица 200, яблоко 150\n"
         "2. Добавляйте свои продукты через меню\n"
         "3. Просматривайте статистику и графики\n\n"
         "Доступные команды:\n"
-        "📊 Итог - общее количество калорий\n"
+        "📊 Итог - калории за сегодня и за всё время\n"
         "🔄 Сбросить - обнулить данные\n"
         "📈 График - статистика за неделю\n"
         "🥧 Топ - самые калорийные продукты\n"
-        "📜 История - последние записи\n\n"
+        "📜 История - записи с листанием\n"
+        "/export - вся история файлом (csv или json)\n"
+        "/timezone - часовой пояс для подсчёта дней\n\n"
         "Для начала работы нажмите /start"
     )
     bot.send_message(
@@ -484,63 +1178,406 @@ def show_help(message):
         reply_markup=create_keyboard()
     )
 
+def suggest_products(message):
+    """Подсказки для текста, который не совпал ни с кнопкой, ни с продуктом"""
+    suggestions = product_catalog().search(message.text)
+    if not suggestions:
+        bot.send_message(
+            message.chat.id,
+            "❓ Такого продукта нет. Добавьте его через «➕ Добавить продукт»",
+            reply_markup=create_keyboard()
+        )
+        return
+    markup = ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    markup.add(*suggestions)
+    markup.row("🏠 Главное меню")
+    bot.send_message(message.chat.id, "🔎 Возможно, вы имели в виду:", reply_markup=markup)
+
+# Шаги многошаговых диалогов: состояние {"step": ..., параметры} хранится
+# в conversations, параметры передаются обработчику шага как аргументы
+STEP_HANDLERS = {
+    "amount": process_product_amount,
+    "add_product": process_add_product,
+    "confirm_replace": confirm_replace,
+    "remove_product": process_remove_product,
+}
+
+# Кнопки меню: один поиск в словаре вместо перебора фильтров всех обработчиков
+MENU_ACTIONS = {
+    "📊 Итог": show_total,
+    "🔄 Сбросить": reset_counter,
+    "📈 График за неделю": send_week_plot,
+    "🥧 Топ продуктов": send_pie_chart,
+    "➕ Добавить продукт": add_new_product,
+    "❌ Удалить продукт": remove_product_start,
+    "📜 История": show_history,
+    "❓ Помощь": show_help,
+    "🏠 Главное меню": main_menu,
+}
+
+def timed(action, message, *args, **kwargs):
+    """Вызов действия с замером времени по его имени"""
+    started = time.perf_counter()
+    try:
+        return action(message, *args, **kwargs)
+    finally:
+        action_seconds.labels(action.__name__).observe(time.perf_counter() - started)
+
+@bot.message_handler(content_types=['text'])
+def route_text(message):
+    """Разбор текстовых сообщений: шаг диалога, кнопка меню, продукт или подсказка"""
+    try:
+        state = conversations.pop(message.chat.id)
+        if state is not None:
+            step = state.pop("step")
+            return timed(STEP_HANDLERS[step], message, **state)
+        action = MENU_ACTIONS.get(message.text)
+        if action is not None:
+            return timed(action, message)
+        if message.text.startswith(MORE_PRODUCTS):
+            return timed(more_products, message)
+        product = product_catalog().lookup(message.text)
+        if product is not None:
+            return timed(add_product, message, product)
+        items = parse_meal(message.text)
+        if items is not None:
+            return timed(process_meal, message, items)
+        timed(suggest_products, message)
+    except Exception as e:
+        logger.error(f"Ошибка в route_text: {e}")
+        bot.send_message(message.chat.id, "⚠️ Произошла ошибка. Попробуйте позже.", reply_markup=create_keyboard())
+
+# ==================== ОЧЕРЕДЬ ОБНОВЛЕНИЙ ====================
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', 4))
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 1000))  # на всех обработчиков
+SEEN_UPDATES_LIMIT = 10000  # сколько последних update_id помнить для отсева повторов
+
+updates_queued = metrics.gauge("updates_queued", "Обновлений ждут обработки")
+updates_overflow = metrics.counter("updates_overflow_total", "Обновлений отклонено из-за переполнения очереди")
+updates_duplicate = metrics.counter("updates_duplicate_total", "Повторно доставленных обновлений")
+update_wait_seconds = metrics.histogram("update_queue_wait_seconds", "Время ожидания обновления в очереди")
+
+# У каждого обработчика своя очередь: все обновления одного чата попадают
+# в одну и ту же очередь и обрабатываются строго по порядку
+update_queues = [queue.Queue(maxsize=max(1, UPDATE_QUEUE_SIZE // UPDATE_WORKERS)) for _ in range(UPDATE_WORKERS)]
+seen_updates = OrderedDict()
+seen_updates_lock = threading.Lock()
+
+def update_chat_id(json_data):
+    """id чата из необработанного обновления (0, если чата нет)"""
+    for value in json_data.values():
+        if isinstance(value, dict):
+            chat = value.get("chat") or (value.get("message") or {}).get("chat") or value.get("from")
+            if isinstance(chat, dict):
+                return chat.get("id", 0)
+    return 0
+
+def accept_update(json_data, put):
+    """Отсев повторов и постановка обновления в очередь через put().
+
+    put() бросает queue.Full при переполнении; тогда возвращается False.
+    """
+    update_id = json_data["update_id"]
+    with seen_updates_lock:
+        if update_id in seen_updates:
+            updates_duplicate.inc()
+            return True
+        updates_queued.inc()
+        try:
+            put(json_data)
+        except queue.Full:
+            # Не запоминаем update_id: Telegram пришлёт обновление повторно
+            updates_queued.inc(-1)
+            updates_overflow.inc()
+            return False
+        seen_updates[update_id] = True
+        if len(seen_updates) > SEEN_UPDATES_LIMIT:
+            seen_updates.popitem(last=False)
+    return True
+
+def put_to_workers(json_data):
+    update_queues[update_chat_id(json_data) % UPDATE_WORKERS].put_nowait((time.monotonic(), json_data))
+
+def handle_update(json_data, put):
+    """Проверка обновления из вебхука; возвращает (текст, код ответа)"""
+    logger.debug("Received update: %s", json_data)
+    if not json_data:
+        logger.error("Empty update received")
+        return "empty update", 400
+    if not isinstance(json_data, dict) or not isinstance(json_data.get("update_id"), int):
+        logger.error("Malformed update received")
+        return "malformed update", 400
+    if not accept_update(json_data, put):
+        logger.warning(f"Очередь обновлений переполнена, update {json_data['update_id']} отклонён")
+        return "busy", 503
+    return "ok", 200
+
+def process_update(json_data):
+    store.refresh()
+    bot.process_new_updates([telebot.types.Update.de_json(json_data)])
+
+def update_worker(updates):
+    """Обработка обновлений из своей очереди"""
+    while True:
+        queued_at, json_data = updates.get()
+        updates_queued.inc(-1)
+        update_wait_seconds.observe(time.monotonic() - queued_at)
+        try:
+            process_update(json_data)
+        except Exception as e:
+            logger.error(f"Ошибка обработки обновления {json_data.get('update_id')}: {e}")
+        finally:
+            updates.task_done()
+
+if RUNTIME == "flask":
+    for index, updates in enumerate(update_queues):
+        threading.Thread(target=update_worker, args=(updates,), name=f"update-worker-{index}", daemon=True).start()
+
+# ==================== АСИНХРОННЫЙ РЕЖИМ ====================
+# RUNTIME=asgi: обновления принимает ASGI-приложение (uvicorn), а запросы
+# к Bot API идут через AsyncTeleBot с общей keep-alive сессией aiohttp.
+# Обработчики синхронные и могут ждать диска (загрузка шарда, fsync,
+# блокировки SQLite, выгрузка истории), поэтому выполняются в потоках
+# handler_pools, а не в цикле событий. Как и в очередях Flask-режима, чат
+# закреплён за одним потоком, так что его обновления идут по порядку.
+# Исходящие сообщения обработчика собираются в outbox и отправляются
+# асинхронно после его завершения.
+ASYNC_CALL_TIMEOUT = 60  # секунд на запрос к API из потока вне цикла событий
+
+async_bot = None
+event_loop = None
+async_tasks = set()
+outbox_var = contextvars.ContextVar("outbox", default=None)
+handler_pools = [
+    ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"update-handler-{index}") for index in range(UPDATE_WORKERS)
+]
+
+def route_outgoing(method, args, kwargs):
+    """Исходящие запросы бота в asyncio-режиме"""
+    outbox = outbox_var.get()
+    if outbox is not None:
+        # Внутри обработчика: запрос уйдёт после его завершения с тем же приоритетом
+        outbox.append((method, args, kwargs, outbound.send_priority.get()))
+        return None
+    # Из других потоков (например, сообщение об ошибке графика) — в очередь без ожидания
+    return send_later(method, args, kwargs)
+
+async def process_update_async(json_data):
+    """Обработка одного обновления: обработчик в потоке чата, отправка в цикле событий"""
+    try:
+        outbox = []
+        context = contextvars.copy_context()
+        context.run(outbox_var.set, outbox)
+        pool = handler_pools[update_chat_id(json_data) % UPDATE_WORKERS]
+        await asyncio.get_running_loop().run_in_executor(pool, context.run, process_update, json_data)
+        if outbox:
+            # Очередь сохраняет порядок запросов одного чата, поэтому
+            # ответы ставятся в неё сразу, а ожидаются вместе
+            await asyncio.gather(*(
+                asyncio.wrap_future(outbound_queue.submit(
+                    outgoing_chat_id(method, args, kwargs), method, args, kwargs, priority
+                ))
+                for method, args, kwargs, priority in outbox
+            ))
+    except Exception as e:
+        logger.error(f"Ошибка обработки обновления {json_data.get('update_id')}: {e}")
+    finally:
+        updates_queued.inc(-1)
+
+def put_to_event_loop(json_data):
+    if len(async_tasks) >= UPDATE_QUEUE_SIZE:
+        raise queue.Full
+    task = event_loop.create_task(process_update_async(json_data))
+    async_tasks.add(task)
+    task.add_done_callback(async_tasks.discard)
+
+async def asgi_lifespan(receive, send):
+    global async_bot, event_loop
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            from telebot.async_telebot import AsyncTeleBot
+            async_bot = AsyncTeleBot(TOKEN)
+            event_loop = asyncio.get_running_loop()
+            bot.route = route_outgoing
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if async_tasks:
+                await asyncio.wait(list(async_tasks), timeout=10)
+            try:
+                await async_bot.close_session()
+            except Exception as e:
+                logger.warning(f"Не удалось закрыть сессию Bot API: {e}")
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def asgi_app(scope, receive, send):
+    """ASGI-приложение: uvicorn bot:asgi_app или python bot.py с RUNTIME=asgi"""
+    if scope["type"] == "lifespan":
+        return await asgi_lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    content_type = "text/plain; charset=utf-8"
+    if scope["path"] == "/webhook" and scope["method"] == "POST":
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        try:
+            text, status = handle_update(json.loads(body) if body else None, put_to_event_loop)
+        except ValueError:
+            text, status = "malformed update", 400
+        except Exception as e:
+            logger.error(f"Webhook error: {str(e)}")
+            text, status = "error", 500
+    elif scope["path"] == "/metrics":
+        text, status = metrics.render(), 200
+        content_type = "text/plain; version=0.0.4"
+    elif scope["path"] == "/debug/profile":
+        params = {k: v[0] for k, v in parse_qs(scope.get("query_string", b"").decode()).items()}
+        # Профилирование длится секунды: в отдельном потоке, чтобы не останавливать цикл событий
+        text, status = await asyncio.get_running_loop().run_in_executor(None, profile_response, params)
+    elif scope["path"] == "/":
+        text, status = home(), 200
+    else:
+        text, status = "not found", 404
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode())],
+    })
+    await send({"type": "http.response.body", "body": text.encode('utf-8')})
+
 # ==================== ВЕБХУК И ЗАПУСК ====================
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    """Обработчик вебхука от Telegram"""
+    """Обработчик вебхука от Telegram: проверка и постановка в очередь"""
     if request.method == "POST":
         try:
-            json_data = request.get_json()
-            logger.info(f"Received update: {json_data}")
-            if not json_data:
-                logger.error("Empty update received")
-                return "empty update", 400
-            update = telebot.types.Update.de_json(json_data)
-            bot.process_new_updates([update])
-            return "ok", 200
+            return handle_update(request.get_json(silent=True), put_to_workers)
         except Exception as e:
             logger.error(f"Webhook error: {str(e)}")
             return "error", 500
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Метрики в формате Prometheus"""
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+# Выборочный профилировщик включается только при заданном PROFILER_TOKEN:
+# GET /debug/profile?token=...&seconds=10 -> свёрнутые стеки для flamegraph
+PROFILER_TOKEN = os.getenv('PROFILER_TOKEN', '')
+
+def profile_response(params):
+    """Ответ /debug/profile: (текст, статус)"""
+    if not PROFILER_TOKEN or not hmac.compare_digest(params.get("token", "").encode(), PROFILER_TOKEN.encode()):
+        return "not found", 404
+    try:
+        seconds = float(params.get("seconds", 10))
+    except ValueError:
+        return "seconds must be a number", 400
+    try:
+        return profiler.sample(seconds), 200
+    except RuntimeError as e:
+        return str(e), 409
+
+@app.route('/debug/profile')
+def profile_endpoint():
+    text, status = profile_response(request.args)
+    return text, status, {'Content-Type': 'text/plain; charset=utf-8'}
+
 @app.route('/')
 def home():
     """Стартовая страница"""
     return "Бот работает! Для проверки отправьте /start в Telegram"
 
-def setup_webhook():
-    """Настройка вебхука с повторами при ошибках"""
-    webhook_url = 'https://telegram-bot-render-h7b5.onrender.com/webhook'
-    max_retries = 3
-    retry_delay = 5
-    
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', 'https://telegram-bot-render-h7b5.onrender.com/webhook')
+
+def setup_webhook(max_retries=5):
+    """Настройка вебхука с повторами; ничего не меняет, если адрес уже установлен"""
+    retry_delay = 1
     for attempt in range(max_retries):
         try:
-            bot.remove_webhook()
-            time.sleep(retry_delay)
-            bot.set_webhook(url=webhook_url)
-            webhook_info = bot.get_webhook_info()
-            logger.info(f"Webhook установлен: {webhook_info}")
+            if bot.get_webhook_info().url == WEBHOOK_URL:
+                logger.info(f"Webhook уже установлен: {WEBHOOK_URL}")
+            else:
+                bot.set_webhook(url=WEBHOOK_URL)
+                logger.info(f"Webhook установлен: {WEBHOOK_URL}")
             return True
         except Exception as e:
             logger.warning(f"Попытка {attempt+1} не удалась: {e}")
             time.sleep(retry_delay)
-    
+            retry_delay *= 2
+    logger.error("Не удалось установить вебхук после нескольких попыток")
     return False
 
-if __name__ == '__main__':
-    logger.info("Запуск бота...")
-    bot.remove_webhook()
-    time.sleep(1)
-    webhook_url = 'https://telegram-bot-render-h7b5.onrender.com/webhook'
+def warm_up_charts():
+    """Запуск процессов пула графиков с загрузкой matplotlib до первого запроса"""
     try:
-        bot.set_webhook(url=webhook_url)
-        logger.info(f"Webhook set to: {webhook_url}")
-        logger.info(f"Current webhook info: {bot.get_webhook_info()}")
+        get_chart_pool().submit(charts.preload).result()
     except Exception as e:
-        logger.error(f"Failed to set webhook: {e}")
-    if setup_webhook():
-        port = int(os.getenv('PORT', 10000))
-        logger.info(f"Сервер запущен на порту {port}")
-        app.run(host='0.0.0.0', port=port)
+        logger.warning(f"Не удалось заранее запустить пул графиков: {e}")
+
+def background_startup():
+    """Настройка вебхука и прогрев графиков, пока сервер уже принимает запросы"""
+    with startup_phase("webhook"):
+        setup_webhook()
+    with startup_phase("chart_pool"):
+        warm_up_charts()
+
+def run_workers(port):
+    """Запуск WORKERS процессов: gunicorn для Flask или uvicorn для ASGI.
+
+    Процессы открывают данные в общем режиме (блокировки шардов на диске),
+    а состояния диалогов по умолчанию держат в SQLite, чтобы шаги диалога
+    не терялись при попадании сообщений в разные процессы.
+    """
+    os.environ["SHARED_STORAGE"] = "1"
+    os.environ.setdefault("STATE_BACKEND", "sqlite")
+    if os.environ["STATE_BACKEND"] == "memory":
+        logger.warning("STATE_BACKEND=memory не работает с несколькими процессами")
+    # Данные этого процесса открыты не в общем режиме — сбрасываем их до запуска воркеров
+    store.close()
+    # Сервер запускается вместо этого процесса: воркеры импортируют bot
+    # один раз, без второй копии модуля под именем __main__
+    if RUNTIME == "asgi":
+        os.execvp("uvicorn", [
+            "uvicorn", "bot:asgi_app",
+            "--app-dir", os.path.dirname(os.path.abspath(__file__)),
+            "--workers", str(WORKERS),
+            "--host", "0.0.0.0",
+            "--port", str(port),
+        ])
     else:
-        logger.error("Не удалось установить вебхук после нескольких попыток")
\ No newline at end of file
+        os.execvp("gunicorn", [
+            "gunicorn", "bot:app",
+            "--workers", str(WORKERS),
+            "--threads", str(UPDATE_WORKERS),
+            "--bind", f"0.0.0.0:{port}",
+        ])
+
+def main():
+    """Запуск сервера: python bot.py"""
+    logger.info("Запуск бота...")
+    # SIGTERM от платформы завершает процесс через sys.exit, чтобы atexit успел сбросить данные
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    port = int(os.getenv('PORT', 10000))
+    startup_seconds.labels("ready").set(round(time.perf_counter() - STARTUP_BEGAN, 4))
+    logger.info(
+        f"Сервер запускается на порту {port} ({RUNTIME}, процессов: {WORKERS}), "
+        f"подготовка заняла {time.perf_counter() - STARTUP_BEGAN:.3f} с"
+    )
+    if WORKERS > 1:
+        # Процессы воркеров заменят этот процесс, поэтому вебхук — до их запуска
+        with startup_phase("webhook"):
+            setup_webhook()
+        run_workers(port)
+    else:
+        threading.Thread(target=background_startup, name="startup", daemon=True).start()
+        if RUNTIME == "asgi":
+            import uvicorn
+            uvicorn.run(asgi_app, host='0.0.0.0', port=port)
+        else:
+            app.run(host='0.0.0.0', port=port)
\ No newline at end of file
@@ -0,0 +1,75 @@
+from bisect import bisect_left
+from collections import defaultdict
+
+# ==================== КАТАЛОГ ПРОДУКТОВ ====================
+# Индекс названий: точный поиск по нормализованному ключу, поиск по префиксу
+# (бинарный поиск по отсортированным ключам) и нечёткий поиск по триграммам,
+# который прощает опечатки: «курца» -> «курица».
+
+FUZZY_THRESHOLD = 0.45  # минимальная похожесть (коэффициент Дайса по триграммам)
+
+
+def normalize(name):
+    """Ключ для сравнения названий: регистр, ё/е и лишние пробелы не важны"""
+    return " ".join(name.lower().replace("ё", "е").split())
+
+
+def trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class Catalog:
+    """Поисковый индекс по названиям продуктов"""
+
+    def __init__(self, names=()):
+        self.names = {}  # нормализованный ключ -> название как в products
+        self.grams = defaultdict(set)  # триграмма -> ключи
+        for name in names:
+            self.names[normalize(name)] = name
+        self.sorted_keys = sorted(self.names)
+        for key in self.sorted_keys:
+            for gram in trigrams(key):
+                self.grams[gram].add(key)
+
+    def __len__(self):
+        return len(self.names)
+
+    def lookup(self, text):
+        """Точное совпадение с точностью до нормализации, иначе None"""
+        return self.names.get(normalize(text))
+
+    def prefix(self, text, limit=10):
+        """Продукты, название которых начинается с text"""
+        key = normalize(text)
+        result = []
+        i = bisect_left(self.sorted_keys, key)
+        while i < len(self.sorted_keys) and len(result) < limit and self.sorted_keys[i].startswith(key):
+            result.append(self.names[self.sorted_keys[i]])
+            i += 1
+        return result
+
+    def fuzzy(self, text, limit=5):
+        """Похожие названия по убыванию похожести"""
+        key_grams = trigrams(normalize(text))
+        shared = defaultdict(int)
+        for gram in key_grams:
+            for key in self.grams.get(gram, ()):
+                shared[key] += 1
+        scored = []
+        for key, count in shared.items():
+            score = 2 * count / (len(key_grams) + len(trigrams(key)))
+            if score >= FUZZY_THRESHOLD:
+                scored.append((score, key))
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        return [self.names[key] for _, key in scored[:limit]]
+
+    def search(self, text, limit=5):
+        """Подсказки для введённого текста: сначала по префиксу, затем нечёткие"""
+        result = self.prefix(text, limit)
+        for name in self.fuzzy(text, limit):
+            if len(result) >= limit:
+                break
+            if name not in result:
+                result.append(name)
+        return result
@@ -0,0 +1,49 @@
+from io import BytesIO
+
+# ==================== ГРАФИКИ ====================
+# Функции выполняются в процессах пула: получают только готовые данные
+# и возвращают PNG в байтах. Объектный API Figure не трогает глобальное
+# состояние pyplot, поэтому безопасен при параллельной отрисовке.
+# matplotlib импортируется при первой отрисовке (или в preload), а не при
+# импорте модуля: запуск бота не ждёт его загрузки.
+
+
+def preload():
+    """Загрузка matplotlib заранее: инициализатор процессов пула"""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg  # noqa: F401
+    from matplotlib.figure import Figure  # noqa: F401
+
+
+def _figure(**kwargs):
+    from matplotlib.figure import Figure
+    return Figure(**kwargs)
+
+
+def _to_png(fig):
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    FigureCanvasAgg(fig)
+    buffer = BytesIO()
+    fig.savefig(buffer, format='png', dpi=80)
+    return buffer.getvalue()
+
+
+def render_week_plot(dates, calories):
+    """График калорий по дням"""
+    fig = _figure(figsize=(10, 5))
+    ax = fig.add_subplot()
+    ax.plot(dates, calories, marker='o', linestyle='-', color='teal')
+    ax.set_title("Калории за неделю")
+    ax.set_xlabel("Дата")
+    ax.set_ylabel("Ккал")
+    ax.grid(True)
+    fig.tight_layout()
+    return _to_png(fig)
+
+
+def render_pie_chart(labels, values):
+    """Круговая диаграмма топа продуктов"""
+    fig = _figure(figsize=(8, 8))
+    ax = fig.add_subplot()
+    ax.pie(values, labels=labels, autopct='%1.1f%%', startangle=90)
+    ax.set_title("Топ продуктов по калориям")
+    return _to_png(fig)
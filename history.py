@@ -0,0 +1,206 @@
+import base64
+import struct
+import sys
+from array import array
+from datetime import date
+
+# ==================== ИСТОРИЯ ПОТРЕБЛЕНИЯ ====================
+# История пользователя хранится по столбцам: номера дней, номера продуктов,
+# граммы и калории — массивы int32 (16 байт на запись) вместо словаря со
+# строками на каждую запись. Названия продуктов хранятся один раз в таблице
+# пользователя. Снаружи история выглядит как список записей-словарей
+# {"product", "amount", "calories", "date"}: их создаёт индексация и срез.
+
+MAGIC = b"CHS1"
+HEADER = struct.Struct("<4sII")  # метка формата, записей, продуктов
+NAME_LENGTH = struct.Struct("<H")
+COLUMNS = ("days", "product_ids", "amounts", "calories")
+
+
+def day_number(date_text):
+    """'%Y-%m-%d' -> порядковый номер дня"""
+    return date.fromisoformat(date_text).toordinal()
+
+
+def day_text(number):
+    return date.fromordinal(number).isoformat()
+
+
+def _int32(values=()):
+    column = array('i', values)
+    if column.itemsize != 4:
+        raise RuntimeError("array('i') не 32-битный на этой платформе")
+    return column
+
+
+class History:
+    """Компактная история записей одного пользователя"""
+    __slots__ = ("names", "ids") + COLUMNS
+
+    def __init__(self, entries=()):
+        self.names = []  # номер продукта -> название
+        self.ids = {}  # название -> номер продукта
+        for column in COLUMNS:
+            setattr(self, column, _int32())
+        for entry in entries:
+            self.append(entry)
+
+    def _product_id(self, name):
+        product_id = self.ids.get(name)
+        if product_id is None:
+            product_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return product_id
+
+    @staticmethod
+    def check(entry):
+        """Числа записи для столбцов: (день, граммы, калории); ValueError/OverflowError, если не подходят"""
+        return _int32((day_number(entry["date"]), int(entry["amount"]), int(entry["calories"])))
+
+    def append(self, entry):
+        """Добавить запись; если она не подходит, столбцы не меняются"""
+        day, amount, calories = self.check(entry)
+        self.days.append(day)
+        self.product_ids.append(self._product_id(entry["product"]))
+        self.amounts.append(amount)
+        self.calories.append(calories)
+
+    def entry(self, i):
+        return {
+            "product": self.names[self.product_ids[i]],
+            "amount": self.amounts[i],
+            "calories": self.calories[i],
+            "date": day_text(self.days[i]),
+        }
+
+    def columns(self):
+        """Снимок для чтения без блокировки: (названия, дни, продукты, граммы, калории, записей)"""
+        return self.names, self.days, self.product_ids, self.amounts, self.calories, len(self)
+
+    @staticmethod
+    def entries_from(columns, start=0):
+        """Записи снимка columns начиная с дня start, по одной"""
+        names, days, product_ids, amounts, calories, count = columns
+        for i in range(count):
+            if days[i] >= start:
+                yield {
+                    "product": names[product_ids[i]],
+                    "amount": amounts[i],
+                    "calories": calories[i],
+                    "date": day_text(days[i]),
+                }
+
+    def raw_entries(self, start, before):
+        """Записи за дни [start, before) в виде словарей"""
+        return [self.entry(i) for i, day in enumerate(self.days) if start <= day < before]
+
+    def rollup(self, start, before):
+        """Свести записи за дни [start, before) в итоговые строки «день + продукт».
+
+        Записи раньше start уже свёрнуты и не меняются, порядок по дням сохраняется.
+        """
+        earlier, later = [], []
+        sums = {}  # (день, продукт) -> [граммы, калории]
+        for i, day in enumerate(self.days):
+            if day < start:
+                earlier.append(i)
+            elif day < before:
+                row = sums.setdefault((day, self.product_ids[i]), [0, 0])
+                row[0] += self.amounts[i]
+                row[1] += self.calories[i]
+            else:
+                later.append(i)
+        if not sums:
+            return
+        rows = [(self.days[i], self.product_ids[i], self.amounts[i], self.calories[i]) for i in earlier]
+        rows += [key + tuple(value) for key, value in sorted(sums.items())]
+        rows += [(self.days[i], self.product_ids[i], self.amounts[i], self.calories[i]) for i in later]
+        for column, values in zip(COLUMNS, zip(*rows)):
+            setattr(self, column, _int32(values))
+
+    def __len__(self):
+        return len(self.days)
+
+    def __bool__(self):
+        return len(self.days) > 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.entry(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("history index out of range")
+        return self.entry(index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.entry(i)
+
+    def __eq__(self, other):
+        if isinstance(other, History):
+            return self.to_bytes() == other.to_bytes()
+        return list(self) == other
+
+    def to_bytes(self):
+        """Двоичное представление: заголовок, таблица названий, столбцы int32 (little-endian)"""
+        parts = [HEADER.pack(MAGIC, len(self), len(self.names))]
+        for name in self.names:
+            encoded = name.encode('utf-8')
+            parts.append(NAME_LENGTH.pack(len(encoded)))
+            parts.append(encoded)
+        for column in COLUMNS:
+            values = getattr(self, column)
+            if sys.byteorder != "little":
+                values = array('i', values)
+                values.byteswap()
+            parts.append(values.tobytes())
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, count, name_count = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("неизвестный формат истории")
+        history = cls()
+        offset = HEADER.size
+        for _ in range(name_count):
+            (length,) = NAME_LENGTH.unpack_from(data, offset)
+            offset += NAME_LENGTH.size
+            history._product_id(data[offset:offset + length].decode('utf-8'))
+            offset += length
+        for column in COLUMNS:
+            values = _int32()
+            values.frombytes(data[offset:offset + 4 * count])
+            if sys.byteorder != "little":
+                values.byteswap()
+            setattr(history, column, values)
+            offset += 4 * count
+        return history
+
+    def to_json(self):
+        """Представление для снимков JSON: двоичные данные в base64"""
+        return {"columnar": base64.b64encode(self.to_bytes()).decode('ascii')}
+
+    @classmethod
+    def load(cls, value):
+        """История из снимка: двоичная форма или прежний список словарей"""
+        if isinstance(value, History):
+            return value
+        if isinstance(value, dict):
+            return cls.from_bytes(base64.b64decode(value["columnar"]))
+        return cls(value or ())
+
+
+def json_default(value):
+    """Хук json.dumps для сохранения History в снимках"""
+    if isinstance(value, History):
+        return value.to_json()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def json_default_entries(value):
+    """Хук json.dumps для прежнего формата user_data.json: история — список словарей"""
+    if isinstance(value, History):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
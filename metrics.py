@@ -0,0 +1,144 @@
+import bisect
+import threading
+
+# ==================== МЕТРИКИ ====================
+# Простейший реестр счётчиков и гистограмм в формате Prometheus
+
+_registry = {}
+_lock = threading.Lock()
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class Counter:
+    """Монотонно растущий счётчик"""
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+
+class Gauge(Counter):
+    """Текущее значение (глубина очереди, размер кэша)"""
+    kind = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    """Распределение значений по корзинам"""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        with self.lock:
+            result = []
+            cumulative = 0
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                result.append((f'{self.name}_bucket{{le="{bound}"}}', cumulative))
+            result.append((f'{self.name}_bucket{{le="+Inf"}}', self.count))
+            result.append((f"{self.name}_sum", self.sum))
+            result.append((f"{self.name}_count", self.count))
+            return result
+
+
+class Family:
+    """Метрика с одной меткой: отдельный экземпляр на каждое её значение"""
+
+    def __init__(self, name, help_text, label, cls, *args):
+        self.name = name
+        self.help = help_text
+        self.kind = cls.kind
+        self.label = label
+        self.cls = cls
+        self.args = args
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, value):
+        child = self.children.get(value)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(value, self.cls(self.name, self.help, *self.args))
+        return child
+
+    def samples(self):
+        result = []
+        for value, child in sorted(list(self.children.items())):
+            escaped = str(value).replace("\\", "\\\\").replace('"', '\\"')
+            pair = f'{self.label}="{escaped}"'
+            for name, sample in child.samples():
+                if "{" in name:
+                    name = name.replace("{", "{" + pair + ",", 1)
+                else:
+                    name = name + "{" + pair + "}"
+                result.append((name, sample))
+        return result
+
+
+def _get_or_create(cls, name, *args):
+    with _lock:
+        if name not in _registry:
+            _registry[name] = cls(name, *args)
+        return _registry[name]
+
+
+def counter(name, help_text):
+    return _get_or_create(Counter, name, help_text)
+
+
+def gauge(name, help_text):
+    return _get_or_create(Gauge, name, help_text)
+
+
+def histogram(name, help_text, buckets=DEFAULT_BUCKETS):
+    return _get_or_create(Histogram, name, help_text, buckets)
+
+
+def counter_family(name, help_text, label):
+    return _get_or_create(Family, name, help_text, label, Counter)
+
+
+def gauge_family(name, help_text, label):
+    return _get_or_create(Family, name, help_text, label, Gauge)
+
+
+def histogram_family(name, help_text, label, buckets=DEFAULT_BUCKETS):
+    return _get_or_create(Family, name, help_text, label, Histogram, buckets)
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in list(_registry.values()):
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, value in metric.samples():
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,223 @@
+import contextvars
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# ==================== ИСХОДЯЩИЕ ЗАПРОСЫ ====================
+# Очередь запросов к Bot API с ограничением скорости: общий лимит на бота
+# и отдельный на каждый чат (token bucket). Запросы одного чата уходят
+# строго по порядку, между чатами первыми идут ответы пользователям,
+# затем массовые рассылки. Ответ 429 откладывает чат на retry_after секунд.
+
+INTERACTIVE, BULK = 0, 1
+
+send_priority = contextvars.ContextVar("send_priority", default=INTERACTIVE)
+
+queue_depth = metrics.gauge("outbound_queued", "Запросов к Bot API ждут отправки")
+queue_wait = metrics.histogram("outbound_queue_wait_seconds", "Время ожидания запроса в очереди отправки")
+send_seconds = metrics.histogram("outbound_send_seconds", "Длительность запроса к Bot API")
+send_retries = metrics.counter("outbound_retries_total", "Повторов после ответа 429")
+send_errors = metrics.counter("outbound_errors_total", "Запросов к Bot API завершилось ошибкой")
+
+
+@contextmanager
+def bulk():
+    """Запросы внутри блока получают низкий приоритет (рассылки, выгрузки)"""
+    token = send_priority.set(BULK)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+
+class TokenBucket:
+    """rate запросов в секунду с запасом не больше burst"""
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_at(self, now):
+        """Момент, когда появится токен"""
+        self._refill(now)
+        return now if self.tokens >= 1 else now + (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class Job:
+    __slots__ = ("method", "args", "kwargs", "priority", "seq", "future", "queued", "attempts")
+
+    def __init__(self, method, args, kwargs, priority, seq):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.future = Future()
+        self.queued = time.monotonic()
+        self.attempts = 0
+
+    def rewind(self):
+        """Файлы (BytesIO графиков) перед повтором читаются с начала"""
+        for value in itertools.chain(self.args, self.kwargs.values()):
+            if hasattr(value, "seek"):
+                value.seek(0)
+
+
+class ChatQueue:
+    __slots__ = ("jobs", "bucket", "not_before", "busy", "scheduled")
+
+    def __init__(self, rate, burst):
+        self.jobs = deque()
+        self.bucket = TokenBucket(rate, burst)
+        self.not_before = 0  # до этого момента чат отложен после 429
+        self.busy = False  # запрос чата уже отправляется
+        self.scheduled = False  # чат стоит в одной из куч
+
+
+class Dispatcher:
+    """Отправка запросов потоками-отправителями с соблюдением лимитов.
+
+    call(method, args, kwargs) выполняет сам запрос и задаётся снаружи:
+    так одна очередь обслуживает и TeleBot, и AsyncTeleBot.
+    """
+
+    def __init__(self, call, workers=4, rate=30, chat_rate=1, chat_burst=3, retries=3):
+        self.call = call
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self.bucket = TokenBucket(rate, rate)
+        self.cond = threading.Condition()
+        self.chats = {}  # chat_id -> ChatQueue
+        self.ready = []  # (приоритет, номер, chat_id): чаты, которые можно обслужить сейчас
+        self.waiting = []  # (момент, номер, chat_id): чаты, ждущие токена или retry_after
+        self.seq = itertools.count()
+        self.queued = 0
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"outbound-{i}", daemon=True).start()
+
+    def submit(self, chat_id, method, args, kwargs, priority=None):
+        """Поставить запрос в очередь; возвращает Future с ответом API.
+
+        chat_id=None — запрос вне чата (ответ на нажатие кнопки): для него
+        действует только общий лимит.
+        """
+        if priority is None:
+            priority = send_priority.get()
+        job = Job(method, args, kwargs, priority, next(self.seq))
+        if chat_id is None:
+            chat_id = ("", job.seq)  # отдельная очередь на один запрос
+        with self.cond:
+            chat = self.chats.get(chat_id)
+            if chat is None:
+                if len(self.chats) >= 10000:
+                    self._forget_idle()
+                chat = self.chats[chat_id] = ChatQueue(self.chat_rate, self.chat_burst)
+            chat.jobs.append(job)
+            self.queued += 1
+            queue_depth.set(self.queued)
+            self._schedule(chat_id, chat, time.monotonic())
+        return job.future
+
+    def _forget_idle(self):
+        # Вызывается под self.cond: чаты без запросов и с полным запасом токенов
+        now = time.monotonic()
+        for chat_id in [k for k, c in self.chats.items() if not c.jobs and not c.busy and c.bucket.full(now)]:
+            del self.chats[chat_id]
+
+    def _schedule(self, chat_id, chat, now):
+        # Вызывается под self.cond
+        if chat.busy or chat.scheduled or not chat.jobs:
+            return
+        chat.scheduled = True
+        at = max(chat.not_before, chat.bucket.ready_at(now))
+        if at <= now:
+            heapq.heappush(self.ready, (chat.jobs[0].priority, chat.jobs[0].seq, chat_id))
+        else:
+            heapq.heappush(self.waiting, (at, next(self.seq), chat_id))
+        self.cond.notify()
+
+    def _next_job(self):
+        """Следующий запрос с учётом приоритетов и лимитов (ждёт, пока такой появится)"""
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                while self.waiting and self.waiting[0][0] <= now:
+                    _, _, chat_id = heapq.heappop(self.waiting)
+                    chat = self.chats[chat_id]
+                    chat.scheduled = False
+                    self._schedule(chat_id, chat, now)
+                timeout = self.waiting[0][0] - now if self.waiting else None
+                if self.ready:
+                    at = self.bucket.ready_at(now)
+                    if at <= now:
+                        _, _, chat_id = heapq.heappop(self.ready)
+                        chat = self.chats[chat_id]
+                        chat.scheduled = False
+                        chat.busy = True
+                        self.bucket.take(now)
+                        chat.bucket.take(now)
+                        self.queued -= 1
+                        queue_depth.set(self.queued)
+                        return chat_id, chat, chat.jobs.popleft()
+                    timeout = min(timeout, at - now) if timeout is not None else at - now
+                self.cond.wait(timeout)
+
+    def _worker(self):
+        while True:
+            chat_id, chat, job = self._next_job()
+            started = time.monotonic()
+            if job.attempts == 0:
+                queue_wait.observe(started - job.queued)
+            job.attempts += 1
+            retry_after = None
+            try:
+                result = self.call(job.method, job.args, job.kwargs)
+            except Exception as e:
+                if getattr(e, "error_code", None) == 429 and job.attempts <= self.retries:
+                    parameters = (getattr(e, "result_json", None) or {}).get("parameters") or {}
+                    retry_after = parameters.get("retry_after", 1)
+                    logger.warning(f"Bot API 429 для чата {chat_id}: повтор через {retry_after} с")
+                    send_retries.inc()
+                else:
+                    send_errors.inc()
+                    job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+            send_seconds.observe(time.monotonic() - started)
+            with self.cond:
+                if retry_after is not None:
+                    job.rewind()
+                    chat.jobs.appendleft(job)
+                    self.queued += 1
+                    queue_depth.set(self.queued)
+                    chat.not_before = time.monotonic() + retry_after
+                chat.busy = False
+                if isinstance(chat_id, tuple) and not chat.jobs:
+                    del self.chats[chat_id]
+                else:
+                    self._schedule(chat_id, chat, time.monotonic())
@@ -0,0 +1,44 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# ==================== ПРОФИЛИРОВЩИК ====================
+# Выборочный профилировщик для диагностики на проде: пока он включён,
+# фоновый цикл раз в interval секунд снимает стеки всех потоков
+# (sys._current_frames) и считает одинаковые. Результат — «свёрнутые
+# стеки» (folded), их принимают flamegraph.pl и speedscope.
+
+MAX_SECONDS = 60
+
+_running = threading.Lock()  # одновременно идёт только одно профилирование
+
+
+def _stack(frame, thread_name):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    names.append(thread_name)
+    return ";".join(reversed(names))
+
+
+def sample(seconds, interval=0.005):
+    """Профилирование процесса в течение seconds секунд, возвращает свёрнутые стеки"""
+    if not _running.acquire(blocking=False):
+        raise RuntimeError("профилирование уже идёт")
+    try:
+        counts = Counter()
+        own = threading.get_ident()
+        deadline = time.monotonic() + min(seconds, MAX_SECONDS)
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own:
+                    counts[_stack(frame, names.get(thread_id, str(thread_id)))] += 1
+            time.sleep(interval)
+    finally:
+        _running.release()
+    return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
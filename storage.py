@@ -0,0 +1,988 @@
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from datetime import date
+
+import metrics
+from history import History, day_number, json_default, json_default_entries
+
+logger = logging.getLogger(__name__)
+
+# ==================== НАСТРОЙКА ====================
+DATA_DIR = os.getenv('DATA_DIR', 'data')
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'wal')  # wal | json
+COMPACT_EVERY = int(os.getenv('COMPACT_EVERY', 1000))  # событий в журнале до сжатия
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 5000))  # пользователей в памяти
+# Общий режим: данные одновременно используют несколько процессов (WORKERS > 1)
+SHARED_STORAGE = os.getenv('SHARED_STORAGE', '0') == '1'
+WAL_FSYNC = os.getenv('WAL_FSYNC', '1') == '1'
+FLUSH_INTERVAL = float(os.getenv('FLUSH_INTERVAL', 1.0))  # секунд между сбросами, 0 — сразу
+FLUSH_EVERY = int(os.getenv('FLUSH_EVERY', 100))  # событий в буфере до досрочного сброса
+# Записи старше срока хранения сворачиваются в итоги «день + продукт», 0 — хранить всё
+HISTORY_RETENTION_DAYS = int(os.getenv('HISTORY_RETENTION_DAYS', 90))
+ROLLUP_INTERVAL = float(os.getenv('ROLLUP_INTERVAL', 3600))  # секунд между проходами свёртки
+
+# Файлы старого формата: читаются при первом запуске для миграции
+PRODUCTS_FILE = "products.json"
+USER_DATA_FILE = "user_data.json"
+
+DEFAULT_PRODUCTS = {"яблоко": 52, "курица": 165, "шоколад": 546}
+
+
+def new_user():
+    """Пустая запись пользователя.
+
+    daily и by_product — нарастающие итоги калорий по дням и по продуктам,
+    чтобы графикам не приходилось обходить всю историю. Сама история —
+    столбцовая History (см. history.py).
+    """
+    return {"total": 0, "history": History(), "daily": {}, "by_product": {}}
+
+
+def upgrade_user(user):
+    """Перевод записи, сохранённой в прежнем формате, на History и итоги"""
+    if not isinstance(user["history"], History):
+        user["history"] = History.load(user["history"])
+    if "daily" not in user:
+        user["daily"] = {}
+        user["by_product"] = {}
+        for entry in user["history"]:
+            add_to_aggregates(user, entry)
+    return user
+
+
+def add_to_aggregates(user, entry):
+    daily, by_product = user["daily"], user["by_product"]
+    daily[entry["date"]] = daily.get(entry["date"], 0) + entry["calories"]
+    by_product[entry["product"]] = by_product.get(entry["product"], 0) + entry["calories"]
+
+
+def empty_state():
+    return {"products": dict(DEFAULT_PRODUCTS), "users": {}}
+
+
+def apply_product_event(products, event):
+    """Применение события к каталогу продуктов"""
+    if event["op"] == "product":
+        products[event["name"]] = event["kcal"]
+    elif event["op"] == "product_del":
+        products.pop(event["name"], None)
+    else:
+        logger.warning(f"Неизвестное событие продуктов: {event['op']}")
+    return products
+
+
+def apply_user_event(user, event):
+    """Применение события к записи пользователя, возвращает новую запись"""
+    op = event["op"]
+    if op == "user":
+        pass
+    elif op == "reset":
+        # Сбрасываются записи и итоги, но не настройки (часовой пояс).
+        # resets — номер сброса: свёртка, начатая до сброса, к новой записи не применяется
+        resets, tz = user.get("resets", 0) + 1, user.get("tz")
+        user = new_user()
+        user["resets"] = resets
+        if tz:
+            user["tz"] = tz
+    elif op in ("entry", "entries"):
+        # entries — несколько записей одним событием: приём пищи целиком
+        upgrade_user(user)
+        entries = event["entries"] if op == "entries" else [event["entry"]]
+        # Проверка до изменений: неподходящая запись не оставляет событие применённым наполовину
+        for entry in entries:
+            History.check(entry)
+        for entry in entries:
+            user["history"].append(entry)
+            user["total"] += entry["calories"]
+            add_to_aggregates(user, entry)
+    elif op == "tz":
+        user["tz"] = event["tz"]
+    elif op == "rollup":
+        # Итоги не меняются: калории уже учтены в daily и by_product
+        upgrade_user(user)
+        start = user.get("rolled_before", 0)
+        if event["before"] > start and event.get("resets", 0) == user.get("resets", 0):
+            user["history"].rollup(start, event["before"])
+            user["rolled_before"] = event["before"]
+    else:
+        logger.warning(f"Неизвестное событие пользователя: {op}")
+    return user
+
+
+def apply_event(state, event):
+    """Применение события к состоянию целиком.
+
+    Один и тот же код работает и для живых изменений, и при восстановлении
+    из журнала, поэтому состояние после перезапуска совпадает с исходным.
+    """
+    if "user" in event:
+        users = state["users"]
+        users[event["user"]] = apply_user_event(users.get(event["user"]) or new_user(), event)
+    else:
+        apply_product_event(state["products"], event)
+    return state
+
+
+def load_legacy_state():
+    """Чтение данных из products.json/user_data.json старого формата"""
+    state = empty_state()
+    if os.path.exists(PRODUCTS_FILE):
+        with open(PRODUCTS_FILE, 'r', encoding='utf-8') as f:
+            state["products"] = json.load(f)
+    if os.path.exists(USER_DATA_FILE):
+        with open(USER_DATA_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        state["users"] = {
+            k: upgrade_user(v if isinstance(v, dict) else {"total": v, "history": []})
+            for k, v in data.items()
+        }
+    return state
+
+
+def load_previous_state(data_dir):
+    """Данные до разбиения на шарды: общий журнал data/bot.* или старые JSON-файлы"""
+    journal = Journal(os.path.join(data_dir, "bot"))
+    if not os.path.exists(journal.snapshot_path):
+        return load_legacy_state(), []
+    old_log_path = journal.log_path + ".old"
+    state = journal.load(empty_state, apply_event, extra_logs=[old_log_path])
+    return state, [journal.snapshot_path, journal.log_path, old_log_path]
+
+
+def write_atomic(path, payload):
+    """Запись файла целиком через временный файл и атомарное переименование"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# ==================== ЖУРНАЛ ====================
+class Journal:
+    """Снимок и журнал событий (write-ahead log) одного ключа.
+
+    Каждое изменение дописывается в конец журнала одной строкой JSON,
+    поэтому стоимость записи не зависит от объёма данных. Когда журнал
+    разрастается, состояние сохраняется новым снимком через атомарное
+    переименование, а журнал обнуляется. У событий есть номер seq, снимок
+    хранит номер последнего учтённого события — поэтому сбой между заменой
+    снимка и очисткой журнала не приводит к повторному применению событий.
+    """
+
+    def __init__(self, path):
+        self.snapshot_path = path + ".json"
+        self.log_path = path + ".wal"
+        self.seq = 0  # номер последнего выданного события
+        self.pending = 0  # событий в журнале после последнего снимка
+        self.offset = 0  # до какого байта журнал прочитан или записан этим процессом
+        self.snapshot_stat = None  # какой снимок загружен (для общего режима)
+        self.log_inode = None  # какой файл журнала прочитан: сжатие заменяет его новым
+
+    def exists(self):
+        return os.path.exists(self.snapshot_path) or os.path.exists(self.log_path)
+
+    def _replay(self, path, state, apply, repair=False, start=0):
+        """Воспроизведение журнала поверх состояния; возвращает (состояние, смещение)"""
+        good_offset = start
+        with open(path, 'rb') as f:
+            f.seek(start)
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("incomplete line")
+                    event = json.loads(line)
+                except ValueError:
+                    # Оборванная при сбое последняя строка (или запись другого процесса ещё идёт)
+                    if repair:
+                        logger.warning(f"Повреждённая запись в {path}, журнал обрезан")
+                        with open(path, 'r+b') as wf:
+                            wf.truncate(good_offset)
+                    break
+                good_offset += len(line)
+                if event["seq"] <= self.seq:
+                    continue
+                state = apply(state, event)
+                self.seq = event["seq"]
+                self.pending += 1
+        return state, good_offset
+
+    def load(self, initial, apply, extra_logs=(), repair=True):
+        """Загрузка снимка и воспроизведение журнала"""
+        self.snapshot_stat = _file_stat(self.snapshot_path)
+        if self.snapshot_stat:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            self.seq, state = snapshot["seq"], snapshot["state"]
+        else:
+            self.seq, state = 0, initial()
+        self.pending = 0
+        self.offset = 0
+        for path in extra_logs:
+            if os.path.exists(path):
+                state, _ = self._replay(path, state, apply)
+        log_stat = _file_stat(self.log_path)
+        self.log_inode = log_stat[0] if log_stat else None
+        if log_stat:
+            state, self.offset = self._replay(self.log_path, state, apply, repair=repair)
+        return state
+
+    def catch_up(self, state, initial, apply, repair=False):
+        """Подхват изменений, которые записали другие процессы.
+
+        Новые строки журнала применяются поверх state; если снимок или файл
+        журнала заменены при сжатии, состояние перечитывается целиком.
+        """
+        log_stat = _file_stat(self.log_path)
+        log_inode, log_size = (log_stat[0], log_stat[2]) if log_stat else (None, 0)
+        if (_file_stat(self.snapshot_path) != self.snapshot_stat or log_inode != self.log_inode
+                or log_size < self.offset):
+            return self.load(initial, apply, repair=repair)
+        if log_size > self.offset:
+            state, self.offset = self._replay(self.log_path, state, apply, repair=repair, start=self.offset)
+        return state
+
+    def write(self, events):
+        """Дописать пачку событий одной записью и одним fsync, возвращает число байт"""
+        payload = "".join(json.dumps(event, ensure_ascii=False) + "\n" for event in events).encode('utf-8')
+        with open(self.log_path, 'ab') as f:
+            f.write(payload)
+            f.flush()
+            if WAL_FSYNC:
+                os.fsync(f.fileno())
+            self.offset = f.tell()
+            self.log_inode = os.fstat(f.fileno()).st_ino
+        self.pending += len(events)
+        return len(payload)
+
+    def compact(self, snapshot_json):
+        """Замена снимка и очистка журнала; все события журнала уже учтены в снимке.
+
+        Пустой журнал заменяет прежний переименованием, а не обрезкой на месте:
+        процесс, который успел перечитать данные между заменой снимка и
+        очисткой журнала, увидит другой inode и не продолжит чтение со
+        старого смещения посреди чужой строки.
+        """
+        write_atomic(self.snapshot_path, snapshot_json)
+        write_atomic(self.log_path, "")
+        self.log_inode = _file_stat(self.log_path)[0]
+        self.snapshot_stat = _file_stat(self.snapshot_path)
+        self.pending = 0
+        self.offset = 0
+        return len(snapshot_json.encode('utf-8'))
+
+
+ARCHIVE_HEADER_MARK = b'{"from": '  # начало строки-заголовка диапазона в архиве истории
+
+
+def truncate_torn_tail(path):
+    """Обрезать файл строк до последнего перевода строки (хвост, оборванный при сбое)"""
+    if not os.path.exists(path):
+        return
+    with open(path, 'r+b') as f:
+        end = pos = f.seek(0, os.SEEK_END)
+        good = 0
+        while pos > 0:
+            step = min(4096, pos)
+            f.seek(pos - step)
+            newline = f.read(step).rfind(b"\n")
+            if newline >= 0:
+                good = pos - step + newline + 1
+                break
+            pos -= step
+        if good < end:
+            logger.warning(f"Оборванная запись в {path}, файл обрезан")
+            f.truncate(good)
+
+
+def _file_stat(path):
+    """(inode, время изменения, размер) файла или None"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+_held_locks = threading.local()  # пути блокировок, которые уже держит этот поток
+
+
+@contextmanager
+def file_lock(path):
+    """Межпроцессная блокировка (flock) на служебном файле.
+
+    Повторный вход из того же потока ничего не делает: flock на новом
+    дескрипторе того же файла ждал бы сам себя.
+    """
+    import fcntl
+    held = _held_locks.__dict__.setdefault("paths", set())
+    if path in held:
+        yield
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        held.add(path)
+        try:
+            yield
+        finally:
+            held.discard(path)
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def snapshot_json(state, seq):
+    return json.dumps({"seq": seq, "state": state}, ensure_ascii=False, default=json_default)
+
+
+# ==================== ОТЛОЖЕННАЯ ЗАПИСЬ ====================
+flush_seconds = metrics.histogram("storage_flush_seconds", "Длительность сброса пачки изменений на диск")
+flush_events = metrics.histogram(
+    "storage_flush_batch_events", "Число событий в одной пачке",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+flush_users = metrics.histogram(
+    "storage_flush_batch_users", "Число изменённых пользователей в одной пачке",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+flush_bytes = metrics.counter("storage_flush_bytes_total", "Байт записано при сбросе")
+buffered_events = metrics.gauge("storage_buffered_events", "Изменений ждут записи на диск")
+rollup_entries = metrics.counter("history_rollup_entries_total", "Записей истории свёрнуто в итоги по дням")
+
+
+class BaseStorage:
+    """Общая часть хранилищ: изменения в памяти и отложенная запись (write-behind).
+
+    commit() применяет событие сразу, а на диск изменения уходят пачкой:
+    раз в FLUSH_INTERVAL секунд, при накоплении FLUSH_EVERY событий и при
+    остановке процесса. FLUSH_INTERVAL=0 включает запись на каждое событие.
+
+    Отдельный поток раз в ROLLUP_INTERVAL секунд сворачивает у пользователей
+    в памяти записи старше HISTORY_RETENTION_DAYS дней (см. rollup_history).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()  # данные в памяти и буферы
+        self.flush_lock = threading.Lock()  # порядок записи на диск
+        self.buffered = 0
+        self.products_revision = 0  # меняется при каждом изменении каталога продуктов
+        self._stopped = False
+        self._wakeup = threading.Event()
+        self._rollup_wakeup = threading.Event()
+        if FLUSH_INTERVAL > 0 and not SHARED_STORAGE:
+            threading.Thread(target=self._flush_loop, name="storage-flush", daemon=True).start()
+        if HISTORY_RETENTION_DAYS > 0:
+            threading.Thread(target=self._rollup_loop, name="history-rollup", daemon=True).start()
+        atexit.register(self.close)
+
+    def commit(self, event):
+        """Применить событие к данным в памяти и поставить его в очередь на запись"""
+        with self.lock:
+            self._apply(event)
+            if "user" not in event:
+                self.products_revision += 1
+            self.buffered += 1
+            buffered_events.set(self.buffered)
+            due = FLUSH_INTERVAL <= 0 or self.buffered >= FLUSH_EVERY
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Записать накопленные изменения одной пачкой"""
+        with self.flush_lock:
+            started = time.perf_counter()
+            events, users, written = self._write_pending()
+            if not events:
+                return
+            flush_seconds.observe(time.perf_counter() - started)
+            flush_events.observe(events)
+            flush_users.observe(users)
+            flush_bytes.inc(written)
+
+    def refresh(self):
+        """Подхват изменений, сделанных другими процессами (только в общем режиме)"""
+
+    def request_flush(self):
+        """Досрочный сброс фоновым потоком"""
+        self._wakeup.set()
+
+    def _flush_loop(self):
+        while not self._stopped:
+            self._wakeup.wait(FLUSH_INTERVAL)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка фоновой записи данных: {e}")
+
+    # ---------- Срок хранения истории ----------
+    def rollup_history(self, user_id, before=None):
+        """Свернуть записи пользователя старше срока хранения; возвращает число записей.
+
+        Исходные записи сначала дописываются в архив пользователя, затем
+        событие rollup заменяет их итогами «день + продукт». Если процесс
+        упадёт между этими шагами, следующая свёртка допишет тот же
+        диапазон заново, а export_history учтёт только последнюю копию.
+
+        В общем режиме архив и событие пишутся под блокировкой шарда:
+        иначе свёртки разных процессов перемешали бы строки архива. Событие
+        несёт номер сброса пользователя: если данные сброшены, пока шла
+        свёртка, оно к новой записи не применяется.
+        """
+        if before is None:
+            before = date.today().toordinal() - HISTORY_RETENTION_DAYS
+        if not self._rollup_entries(user_id, before):
+            return 0
+        with self._user_exclusive(user_id):
+            # Заново под блокировкой: другой процесс мог уже свернуть этот диапазон
+            entries = self._rollup_entries(user_id, before)
+            if not entries:
+                return 0
+            start, resets, entries = entries
+            path = self._archive_path(user_id)
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            # Заголовок диапазона, затем по записи на строку: архив читается потоком
+            lines = [json.dumps({"from": start, "before": before, "count": len(entries)})]
+            lines.extend(json.dumps(entry, ensure_ascii=False) for entry in entries)
+            truncate_torn_tail(path)
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write("\n".join(lines) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.commit({"op": "rollup", "user": user_id, "before": before, "resets": resets})
+        rollup_entries.inc(len(entries))
+        return len(entries)
+
+    def _rollup_entries(self, user_id, before):
+        """(начало, номер сброса, исходные записи) ещё не свёрнутого диапазона до before или None"""
+        user = self.users.get(user_id)
+        if not user:
+            return None
+        with self.lock:
+            start, resets = user.get("rolled_before", 0), user.get("resets", 0)
+            entries = upgrade_user(user)["history"].raw_entries(start, before)
+        return (start, resets, entries) if entries else None
+
+    def export_history(self, user_id):
+        """Полная история пользователя без свёртки: генератор записей из архива и текущих.
+
+        Память не зависит от объёма истории: архив читается построчно,
+        а текущие записи берутся прямо из столбцов History.
+        """
+        user = self.users.get(user_id)
+        if not user:
+            return
+        with self.lock:
+            rolled_before = user.get("rolled_before", 0)
+            # Ссылки на столбцы: свёртка заменяет их новыми, а добавление
+            # записей не трогает первые count строк
+            history = upgrade_user(user)["history"]
+            columns = history.columns()
+        if rolled_before:
+            yield from self._archived_entries(user_id, rolled_before)
+        yield from History.entries_from(columns, rolled_before)
+
+    def _archived_entries(self, user_id, rolled_before):
+        path = self._archive_path(user_id)
+        if not os.path.exists(path):
+            return
+        # Первый проход — только заголовки: какие диапазоны целы и действительны
+        # и до какого дня каждый из них не перекрыт диапазоном, начатым заново
+        chunks = []  # [(смещение первой записи, начало, граница, записей)] в порядке записи
+        with open(path, 'rb') as f:
+            offset = remaining = 0
+            for line in f:
+                offset += len(line)
+                # Заголовок ищется и внутри строки: в старых архивах он мог
+                # оказаться приклеен к оборванной при сбое записи
+                pos = line.find(ARCHIVE_HEADER_MARK)
+                if pos < 0:
+                    if remaining and line.endswith(b"\n"):
+                        remaining -= 1
+                    elif remaining:
+                        chunks.pop()  # диапазон оборван
+                        remaining = 0
+                    continue
+                if remaining:
+                    chunks.pop()  # предыдущий диапазон дописан не до конца
+                try:
+                    header = json.loads(line[pos:])
+                    chunks.append((offset, header["from"], header["before"], header["count"]))
+                    remaining = header["count"]
+                except (ValueError, KeyError, TypeError):
+                    remaining = 0  # заголовок повреждён: его записи пропускаются как лишние строки
+        if remaining:
+            chunks.pop()  # последний диапазон дописан не до конца
+        cuts = []  # для каждого диапазона: записи с днём не раньше cut заменены более поздней копией
+        cut = float("inf")
+        for _, start, before, _ in reversed(chunks):
+            # Действительны диапазоны, чья свёртка завершилась после последнего сброса
+            valid = before <= rolled_before
+            cuts.append(cut if valid else None)
+            if valid:
+                cut = min(cut, start)
+        cuts.reverse()
+        with open(path, 'rb') as f:
+            for (offset, _, _, count), cut in zip(chunks, cuts):
+                if cut is None:
+                    continue
+                f.seek(offset)
+                for _ in range(count):
+                    try:
+                        entry = json.loads(f.readline())
+                        day = day_number(entry["date"])
+                    except (ValueError, KeyError, TypeError):
+                        logger.warning(f"Повреждённая запись в архиве {path}, пропущена")
+                        continue
+                    if day < cut:
+                        yield entry
+
+    def _rollup_loop(self):
+        while not self._stopped:
+            self._rollup_wakeup.wait(ROLLUP_INTERVAL)
+            for user_id in self._rollup_candidates():
+                if self._stopped:
+                    break
+                try:
+                    self.rollup_history(user_id)
+                except Exception as e:
+                    logger.error(f"Ошибка свёртки истории {user_id}: {e}")
+
+    def _rollup_candidates(self):
+        """Пользователи, которых стоит проверить при очередном проходе свёртки"""
+        raise NotImplementedError
+
+    def _archive_path(self, user_id):
+        raise NotImplementedError
+
+    def _user_exclusive(self, user_id):
+        """Межпроцессная блокировка пользователя (нужна только общему режиму)"""
+        return nullcontext()
+
+    def _apply(self, event):
+        raise NotImplementedError
+
+    def _write_pending(self):
+        """Записать буфер; возвращает (событий, пользователей, байт)"""
+        raise NotImplementedError
+
+    def close(self):
+        """Сброс оставшихся изменений при остановке"""
+        self._stopped = True
+        self._wakeup.set()
+        self._rollup_wakeup.set()
+        self.flush()
+
+
+# ==================== ХРАНИЛИЩА ====================
+PRODUCTS_KEY = ""  # ключ каталога продуктов среди шардов
+
+
+class Shard:
+    """Состояние одного ключа, его журнал и ещё не записанные события"""
+    __slots__ = ("journal", "state", "buffer", "compact_due")
+
+    def __init__(self, journal, state):
+        self.journal = journal
+        self.state = state
+        self.buffer = []
+        self.compact_due = False  # переписать снимок при ближайшей записи (после свёртки)
+
+
+class UserCache:
+    """Доступ к пользователям как к словарю: записи подгружаются из шардов по требованию"""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def get(self, user_id, default=None):
+        shard = self.storage.user_shard(user_id)
+        return shard.state if shard else default
+
+    def __contains__(self, user_id):
+        return self.storage.user_shard(user_id) is not None
+
+    def __getitem__(self, user_id):
+        shard = self.storage.user_shard(user_id)
+        if shard is None:
+            raise KeyError(user_id)
+        return shard.state
+
+
+cache_hits = metrics.counter("storage_user_cache_hits_total", "Пользователь найден в кэше")
+cache_misses = metrics.counter("storage_user_cache_misses_total", "Пользователь загружен с диска")
+cache_evictions = metrics.counter("storage_user_cache_evictions_total", "Пользователь вытеснен из кэша")
+cache_size = metrics.gauge("storage_user_cache_size", "Пользователей в кэше")
+
+
+class WalStorage(BaseStorage):
+    """Хранилище на журналах событий: O(1) запись на каждое изменение.
+
+    Каталог продуктов и каждый пользователь живут в отдельных шардах
+    (снимок + журнал) в data/users/<последние 2 цифры id>/<id>.*. При старте
+    читается только каталог, пользователи загружаются при первом обращении
+    в LRU-кэш на USER_CACHE_SIZE записей. Вытесненная запись с незаписанными
+    изменениями остаётся в self.dirty до ближайшего сброса и при повторном
+    обращении берётся оттуда, а не с диска.
+
+    В общем режиме (SHARED_STORAGE=1) одни и те же файлы используют несколько
+    процессов: запись идёт сразу на диск под flock-блокировкой шарда, так что
+    изменения одного чата выполняются строго по очереди, а перед чтением
+    шард догоняет чужие записи по хвосту журнала. Изменения каталога другие
+    процессы замечают в refresh() по размеру журнала и версии снимка.
+    """
+
+    def __init__(self, data_dir=DATA_DIR):
+        self.data_dir = data_dir
+        self.users_dir = os.path.join(data_dir, "users")
+        os.makedirs(self.users_dir, exist_ok=True)
+        self.cache = OrderedDict()  # user_id -> Shard
+        self.dirty = {}  # ключ -> Shard с событиями, ещё не записанными на диск
+        journal = Journal(os.path.join(data_dir, "products"))
+        with self._exclusive(journal.log_path):
+            if not journal.exists():
+                self._migrate(journal)
+            self.products_shard = Shard(journal, journal.load(lambda: dict(DEFAULT_PRODUCTS), apply_product_event))
+        self.products = self.products_shard.state
+        self.users = UserCache(self)
+        super().__init__()
+
+    def _user_path(self, user_id):
+        return os.path.join(self.users_dir, user_id[-2:], user_id)
+
+    def _archive_path(self, user_id):
+        return self._user_path(user_id) + ".archive.jsonl"
+
+    def _user_exclusive(self, user_id):
+        path = self._user_path(user_id) + ".wal"
+        if SHARED_STORAGE:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return self._exclusive(path)
+
+    def _rollup_candidates(self):
+        # Только пользователи в кэше: остальные не занимают память и
+        # будут свёрнуты после того, как снова загрузятся
+        with self.lock:
+            return list(self.cache)
+
+    def _migrate(self, products_journal):
+        """Раскладка данных прежних форматов по шардам при первом запуске"""
+        state, old_files = load_previous_state(self.data_dir)
+        for user_id, user in state["users"].items():
+            os.makedirs(os.path.dirname(self._user_path(user_id)), exist_ok=True)
+            write_atomic(self._user_path(user_id) + ".json", snapshot_json(user, 0))
+        write_atomic(products_journal.snapshot_path, snapshot_json(state["products"], 0))
+        for path in old_files:
+            if os.path.exists(path):
+                os.replace(path, path + ".migrated")
+        logger.info(f"Данные перенесены в шарды: {len(state['users'])} пользователей")
+
+    def _exclusive(self, path):
+        """Межпроцессная блокировка шарда в общем режиме"""
+        return file_lock(path + ".lock") if SHARED_STORAGE else nullcontext()
+
+    def user_shard(self, user_id):
+        """Шард пользователя из кэша или с диска; None, если пользователя нет"""
+        with self.lock:
+            return self._lookup(user_id, repair=not SHARED_STORAGE)
+
+    def _lookup(self, user_id, create=False, repair=False):
+        # Вызывается под self.lock: загрузка с диска тоже под ним, чтобы
+        # в памяти никогда не оказалось двух копий одного пользователя.
+        # repair обрезает оборванный хвост журнала; в общем режиме это можно
+        # делать только под flock шарда (из commit), иначе обрежется запись,
+        # которую другой процесс ещё не закончил
+        shard = self.cache.get(user_id)
+        if shard is not None:
+            self.cache.move_to_end(user_id)
+            cache_hits.inc()
+            if SHARED_STORAGE:
+                shard.state = upgrade_user(shard.journal.catch_up(shard.state, new_user, apply_user_event, repair))
+            return shard
+        # Вытесненный, но ещё не записанный шард новее того, что на диске
+        shard = self.dirty.get(user_id)
+        if shard is None:
+            journal = Journal(self._user_path(user_id))
+            if not journal.exists():
+                if not create:
+                    return None
+                os.makedirs(os.path.dirname(journal.log_path), exist_ok=True)
+            cache_misses.inc()
+            shard = Shard(journal, upgrade_user(journal.load(new_user, apply_user_event, repair=repair)))
+        self.cache[user_id] = shard
+        while len(self.cache) > USER_CACHE_SIZE:
+            _, evicted = self.cache.popitem(last=False)
+            cache_evictions.inc()
+            if evicted.buffer:
+                self.request_flush()
+        cache_size.set(len(self.cache))
+        return shard
+
+    def commit(self, event):
+        if not SHARED_STORAGE:
+            return super().commit(event)
+        # Общий режим: событие сразу пишется на диск под блокировкой шарда
+        key = event.get("user", PRODUCTS_KEY)
+        if key:
+            log_path = self._user_path(key) + ".wal"
+            os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        else:
+            log_path = self.products_shard.journal.log_path
+        with self._exclusive(log_path):
+            with self.lock:
+                shard = self._lookup(key, create=True, repair=True) if key else self._refresh_products(repair=True)
+                self._apply(event)
+                if not key:
+                    self.products_revision += 1
+                pending, shard.buffer = shard.buffer, []
+                self.dirty.pop(key, None)
+            started = time.perf_counter()
+            written = shard.journal.write(pending) + self._maybe_compact(shard)
+        flush_seconds.observe(time.perf_counter() - started)
+        flush_events.observe(len(pending))
+        flush_users.observe(1 if key else 0)
+        flush_bytes.inc(written)
+
+    def refresh(self):
+        if SHARED_STORAGE:
+            with self.lock:
+                self._refresh_products()
+
+    def _refresh_products(self, repair=False):
+        # Вызывается под self.lock; словарь products подменяется на месте,
+        # потому что на него ссылается bot.py
+        shard = self.products_shard
+        seq = shard.journal.seq
+        state = shard.journal.catch_up(shard.state, lambda: dict(DEFAULT_PRODUCTS), apply_product_event, repair)
+        if state is not shard.state:
+            shard.state.clear()
+            shard.state.update(state)
+            self.products_revision += 1
+        elif shard.journal.seq != seq:
+            self.products_revision += 1
+        return shard
+
+    def _maybe_compact(self, shard):
+        """Новый снимок шарда, если журнал разросся или история свёрнута; возвращает число байт"""
+        if shard.journal.pending < COMPACT_EVERY and not shard.compact_due:
+            return 0
+        with self.lock:
+            payload = snapshot_json(shard.state, shard.journal.seq)
+            shard.compact_due = False
+        return shard.journal.compact(payload)
+
+    def _apply(self, event):
+        if "user" in event:
+            key = event["user"]
+            shard = self._lookup(key, create=True, repair=not SHARED_STORAGE)
+            shard.state = apply_user_event(shard.state, event)
+            if event["op"] == "rollup":
+                shard.compact_due = True
+        else:
+            key = PRODUCTS_KEY
+            shard = self.products_shard
+            apply_product_event(shard.state, event)
+        shard.journal.seq += 1
+        event["seq"] = shard.journal.seq
+        shard.buffer.append(event)
+        self.dirty[key] = shard
+
+    def _write_pending(self):
+        with self.lock:
+            batch = [(key, shard, shard.buffer) for key, shard in self.dirty.items() if shard.buffer]
+            for _, shard, _ in batch:
+                shard.buffer = []
+            self.buffered = 0
+            buffered_events.set(0)
+        events = written = 0
+        for key, shard, pending in batch:
+            try:
+                written += shard.journal.write(pending)
+                events += len(pending)
+                written += self._maybe_compact(shard)
+            except Exception as e:
+                logger.error(f"Ошибка записи шарда {key or 'products'}: {e}")
+                with self.lock:
+                    shard.buffer[:0] = pending
+                    self.buffered += len(pending)
+        with self.lock:
+            # Шард покидает self.dirty только когда всё записано на диск
+            for key, shard, _ in batch:
+                if not shard.buffer and self.dirty.get(key) is shard:
+                    del self.dirty[key]
+        users = sum(1 for key, _, _ in batch if key != PRODUCTS_KEY)
+        return events, users, written
+
+
+class JsonStorage(BaseStorage):
+    """Прежний формат: products.json и user_data.json переписываются целиком"""
+
+    def __init__(self):
+        self.state = load_legacy_state()
+        self.products = self.state["products"]
+        self.users = self.state["users"]
+        self.dirty_users = set()
+        super().__init__()
+
+    def _archive_path(self, user_id):
+        return os.path.join(DATA_DIR, "archive", user_id + ".jsonl")
+
+    def _rollup_candidates(self):
+        with self.lock:
+            return list(self.users)
+
+    def _apply(self, event):
+        apply_event(self.state, event)
+        if "user" in event:
+            self.dirty_users.add(event["user"])
+
+    def _write_pending(self):
+        # Одна перезапись файлов на всю пачку изменений
+        with self.lock:
+            events, self.buffered = self.buffered, 0
+            users, self.dirty_users = len(self.dirty_users), set()
+            buffered_events.set(0)
+            if not events:
+                return 0, 0, 0
+            products_json = json.dumps(self.products, ensure_ascii=False, indent=2)
+            # История — списком записей, как в исходном формате: файл читается и прежней версией
+            users_json = json.dumps(self.users, ensure_ascii=False, indent=2, default=json_default_entries)
+        write_atomic(PRODUCTS_FILE, products_json)
+        write_atomic(USER_DATA_FILE, users_json)
+        return events, users, len(products_json.encode('utf-8')) + len(users_json.encode('utf-8'))
+
+
+# ==================== СОСТОЯНИЕ ДИАЛОГОВ ====================
+# Шаг многошагового диалога (например, «ждём граммы для курицы») хранится
+# по chat_id с ограниченным временем жизни. Состояние — небольшой словарь
+# JSON, поэтому его можно держать вне процесса и делить между воркерами.
+
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory')  # memory | sqlite | redis
+STATE_TTL = int(os.getenv('STATE_TTL', 600))  # секунд до забывания незавершённого диалога
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+
+
+class MemoryStateStore:
+    """Состояния в памяти процесса: подходит для одного воркера"""
+
+    def __init__(self, ttl=STATE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.states = {}  # chat_id -> (истекает, состояние)
+        self.writes = 0
+
+    def set(self, chat_id, state):
+        with self.lock:
+            now = time.time()
+            self.states[str(chat_id)] = (now + self.ttl, state)
+            self.writes += 1
+            if self.writes % 1000 == 0:
+                self.states = {k: v for k, v in self.states.items() if v[0] > now}
+
+    def pop(self, chat_id):
+        """Забрать состояние чата (None, если его нет или оно истекло)"""
+        with self.lock:
+            expires, state = self.states.pop(str(chat_id), (0, None))
+        return state if expires > time.time() else None
+
+    def clear(self, chat_id):
+        with self.lock:
+            self.states.pop(str(chat_id), None)
+
+
+class SqliteStateStore:
+    """Состояния в SQLite (режим WAL): общие для процессов на одной машине"""
+
+    def __init__(self, path=os.path.join(DATA_DIR, "states.sqlite3"), ttl=STATE_TTL):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS states (chat_id TEXT PRIMARY KEY, state TEXT, expires REAL)"
+        )
+        self.writes = 0
+
+    def set(self, chat_id, state):
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO states VALUES (?, ?, ?)",
+                (str(chat_id), json.dumps(state, ensure_ascii=False), now + self.ttl),
+            )
+            self.writes += 1
+            if self.writes % 1000 == 0:
+                self.db.execute("DELETE FROM states WHERE expires <= ?", (now,))
+
+    def pop(self, chat_id):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute(
+                    "SELECT state, expires FROM states WHERE chat_id = ?", (str(chat_id),)
+                ).fetchone()
+                if row:
+                    self.db.execute("DELETE FROM states WHERE chat_id = ?", (str(chat_id),))
+            finally:
+                self.db.execute("COMMIT")
+        if row and row[1] > time.time():
+            return json.loads(row[0])
+        return None
+
+    def clear(self, chat_id):
+        with self.lock:
+            self.db.execute("DELETE FROM states WHERE chat_id = ?", (str(chat_id),))
+
+
+class RedisStateStore:
+    """Состояния в Redis или совместимом сервере; нужен пакет redis"""
+
+    def __init__(self, url=REDIS_URL, ttl=STATE_TTL):
+        import redis
+        self.ttl = ttl
+        self.client = redis.Redis.from_url(url)
+
+    def _key(self, chat_id):
+        return f"calbot:state:{chat_id}"
+
+    def set(self, chat_id, state):
+        self.client.set(self._key(chat_id), json.dumps(state, ensure_ascii=False), ex=self.ttl)
+
+    def pop(self, chat_id):
+        pipe = self.client.pipeline()
+        pipe.get(self._key(chat_id))
+        pipe.delete(self._key(chat_id))
+        value, _ = pipe.execute()
+        return json.loads(value) if value else None
+
+    def clear(self, chat_id):
+        self.client.delete(self._key(chat_id))
+
+
+def open_state_store(backend=STATE_BACKEND):
+    """Создание хранилища состояний диалогов выбранного типа"""
+    if backend == "memory":
+        return MemoryStateStore()
+    if backend == "sqlite":
+        return SqliteStateStore()
+    if backend == "redis":
+        return RedisStateStore()
+    raise ValueError(f"Неизвестный тип хранилища состояний: {backend}")
+
+
+def open_storage(backend=STORAGE_BACKEND):
+    """Создание хранилища выбранного типа"""
+    if backend == "json":
+        if SHARED_STORAGE:
+            raise ValueError("Хранилище json не поддерживает общий режим, используйте wal")
+        return JsonStorage()
+    if backend == "wal":
+        return WalStorage()
+    raise ValueError(f"Неизвестный тип хранилища: {backend}")
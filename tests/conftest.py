@@ -0,0 +1,53 @@
+import itertools
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Настройки читаются при импорте модулей: bot.py в тестах работает с
+# временным каталогом данных и ненастоящим токеном
+os.environ.setdefault("TOKEN", "123456:TEST")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="calbot-test-"))
+
+import storage  # noqa: E402
+
+
+@pytest.fixture
+def make_storage(tmp_path, monkeypatch):
+    """Фабрика WalStorage в tmp_path без фоновых потоков записи и свёртки"""
+    monkeypatch.setattr(storage, "FLUSH_INTERVAL", 0)
+    monkeypatch.setattr(storage, "HISTORY_RETENTION_DAYS", 0)
+    monkeypatch.chdir(tmp_path)
+    opened = []
+
+    def make(shared=False):
+        monkeypatch.setattr(storage, "SHARED_STORAGE", shared)
+        store = storage.WalStorage(str(tmp_path / "data"))
+        opened.append(store)
+        return store
+
+    yield make
+    for store in opened:
+        store._stopped = True
+
+
+chat_ids = itertools.count(1000)
+
+
+@pytest.fixture
+def bot(monkeypatch):
+    """Модуль bot с перехватом исходящих запросов: bot.sent — [(метод, args, kwargs)]"""
+    import bot
+    sent = []
+    monkeypatch.setattr(bot.bot, "route", lambda method, args, kwargs: sent.append((method, args, kwargs)))
+    monkeypatch.setattr(bot, "sent", sent, raising=False)
+    return bot
+
+
+@pytest.fixture
+def chat_id():
+    """Новый чат на каждый тест: данные бота общие на всю сессию"""
+    return next(chat_ids)
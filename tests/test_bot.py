@@ -0,0 +1,176 @@
+import time
+from datetime import timedelta, timezone
+from email.parser import BytesParser
+from email.policy import default as email_policy
+from io import BytesIO
+
+import telebot
+
+from history import day_number
+
+
+def message(chat_id, text):
+    return telebot.types.Message.de_json({
+        "message_id": 1, "date": 0, "text": text,
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "test"},
+    })
+
+
+def replies(bot):
+    return [kwargs.get("text", args[1] if len(args) > 1 else None) for method, args, kwargs in bot.sent]
+
+
+# ==================== ЧАСОВЫЕ ПОЯСА ====================
+def test_parse_timezone_accepts_names_and_offsets(bot):
+    assert bot.parse_timezone("+3") == timezone(timedelta(hours=3))
+    assert bot.parse_timezone("UTC-05:30") == timezone(-timedelta(hours=5, minutes=30))
+    assert bot.parse_timezone("gmt+0530") == timezone(timedelta(hours=5, minutes=30))
+    assert str(bot.parse_timezone(" Europe/Moscow ")) == "Europe/Moscow"
+
+
+def test_parse_timezone_rejects_unknown(bot):
+    assert bot.parse_timezone("+15") is None
+    assert bot.parse_timezone("Mars/Olympus") is None
+    assert bot.parse_timezone("../etc/passwd") is None
+    assert bot.parse_timezone("") is None
+
+
+def test_local_day_follows_user_timezone(bot, chat_id):
+    east, west = str(chat_id), str(chat_id + 100000)
+    bot.save_data("tz", user=east, tz="+14")
+    bot.save_data("tz", user=west, tz="-12")
+    # 26 часов разницы: местные даты не совпадают никогда
+    assert bot.local_today(east) > bot.local_today(west)
+
+
+def test_today_calories_counts_only_local_today(bot, chat_id):
+    user_id = str(chat_id)
+    bot.save_data("tz", user=user_id, tz="Pacific/Kiritimati")
+    today = bot.local_today(user_id)
+    bot.save_data("entries", user=user_id, entries=[
+        {"product": "яблоко", "amount": 100, "calories": 52, "date": today},
+        {"product": "курица", "amount": 100, "calories": 165, "date": today},
+        {"product": "курица", "amount": 100, "calories": 165, "date": "2020-01-01"},
+    ])
+    assert bot.today_calories(user_id) == 217
+    assert bot.user_data[user_id]["total"] == 382
+
+
+def test_timezone_survives_reset(bot, chat_id):
+    bot.set_timezone(message(chat_id, "/timezone Pacific/Kiritimati"))
+    bot.reset_counter(message(chat_id, "🔄 Сбросить"))
+    assert bot.user_data[str(chat_id)]["tz"] == "Pacific/Kiritimati"
+    assert bot.user_data[str(chat_id)]["total"] == 0
+
+
+# ==================== ПРИЁМ ПИЩИ ====================
+def test_parse_meal_separators_and_units(bot):
+    assert bot.parse_meal("курица 200, яблоко 150г; шоколад 30 гр.\nсыр 20g") == [
+        ("курица", 200), ("яблоко", 150), ("шоколад", 30), ("сыр", 20),
+    ]
+    assert bot.parse_meal("курица гриль 200") == [("курица гриль", 200)]
+
+
+def test_parse_meal_rejects_other_text(bot):
+    assert bot.parse_meal("банан:95") is None  # формат добавления продукта
+    assert bot.parse_meal("курица") is None
+    assert bot.parse_meal("200") is None
+    assert bot.parse_meal("курица 200, яблоко") is None
+
+
+def test_process_meal_records_all_items_as_one_event(bot, chat_id):
+    bot.process_meal(message(chat_id, ""), [("курица", 200), ("Яблоко", 100)])
+    user = bot.user_data.get(str(chat_id))
+    assert [e["product"] for e in user["history"]] == ["курица", "яблоко"]
+    assert user["total"] == 382
+    assert replies(bot)[-1].startswith("✅ Добавлено:")
+
+
+def test_process_meal_is_all_or_nothing(bot, chat_id):
+    bot.process_meal(message(chat_id, ""), [("курица", 200), ("курца", 100)])
+    bot.process_meal(message(chat_id, ""), [("курица", 200), ("яблоко", 0)])
+    bot.process_meal(message(chat_id, ""), [("курица", 200), ("яблоко", bot.MAX_AMOUNT + 1)])
+    assert not bot.user_data.get(str(chat_id))
+    texts = replies(bot)
+    assert len(texts) == 3 and all(text.startswith("❌") for text in texts)
+    assert "курца (возможно: курица)" in texts[0]
+
+
+# ==================== ИСТОРИЯ ====================
+def history_buttons(markup):
+    return {button.text: button.callback_data for row in markup.keyboard for button in row}
+
+
+def add_history(bot, user_id, count, date="2026-01-01"):
+    bot.save_data("entries", user=user_id, entries=[
+        {"product": "яблоко", "amount": 100 + i, "calories": 52, "date": date} for i in range(count)
+    ])
+
+
+def test_history_pages_follow_cursors(bot, chat_id):
+    user_id = str(chat_id)
+    assert bot.history_page(user_id) is None
+    add_history(bot, user_id, 25)
+    text, markup = bot.history_page(user_id)
+    assert "(16–25 из 25)" in text and list(history_buttons(markup)) == ["⬅️ Раньше"]
+    text, markup = bot.history_page(user_id, history_buttons(markup)["⬅️ Раньше"][len(bot.HISTORY_CURSOR):])
+    assert "(6–15 из 25)" in text
+    text, markup = bot.history_page(user_id, history_buttons(markup)["⬅️ Раньше"][len(bot.HISTORY_CURSOR):])
+    assert "(1–10 из 25)" in text and list(history_buttons(markup)) == ["Позже ➡️"]
+    # Новые записи не сдвигают уже показанные страницы
+    add_history(bot, user_id, 3)
+    text, _ = bot.history_page(user_id, history_buttons(markup)["Позже ➡️"][len(bot.HISTORY_CURSOR):])
+    assert "(11–20 из 28)" in text
+
+
+def test_stale_history_cursor_opens_latest_page(bot, chat_id):
+    user_id = str(chat_id)
+    add_history(bot, user_id, 15, date="2020-01-01")
+    add_history(bot, user_id, 30)
+    _, markup = bot.history_page(user_id)
+    _, markup = bot.history_page(user_id, history_buttons(markup)["⬅️ Раньше"][len(bot.HISTORY_CURSOR):])
+    cursor = history_buttons(markup)["⬅️ Раньше"][len(bot.HISTORY_CURSOR):]
+    bot.store.rollup_history(user_id, day_number("2021-01-01"))
+    text, _ = bot.history_page(user_id, cursor)
+    assert text == bot.history_page(user_id)[0]
+    # Кнопки, отправленные до появления нумерации в курсоре
+    assert bot.history_page(user_id, "5")[0] == text
+
+
+# ==================== ВЫГРУЗКА ====================
+def test_export_sends_file_and_closes_it(bot, chat_id, monkeypatch):
+    uploads = []
+
+    def call(method, args, kwargs):
+        uploads.append((method, args[1], args[1].read(), kwargs["visible_file_name"]))
+    monkeypatch.setattr(bot.outbound_queue, "call", call)
+    add_history(bot, str(chat_id), 2)
+    bot.export_command(message(chat_id, "/export"))
+    for _ in range(500):
+        if uploads and uploads[0][1].closed:
+            break
+        time.sleep(0.01)
+    method, export_file, data, name = uploads[0]
+    assert (method, name) == ("send_document", "history.csv")
+    assert data.decode().splitlines() == [
+        "date,product,amount,calories", "2026-01-01,яблоко,100,52", "2026-01-01,яблоко,101,52",
+    ]
+    assert export_file.closed
+
+
+def test_multipart_upload_streams_file(bot):
+    document = BytesIO(b"x" * (bot.UPLOAD_CHUNK * 2 + 1))
+    upload = bot.MultipartUpload({"chat_id": 5, "caption": "📤 история"}, "document", "history.csv", document)
+    chunks = list(upload)
+    body = b"".join(chunks)
+    assert len(body) == len(upload) and max(map(len, chunks)) <= bot.UPLOAD_CHUNK
+    parsed = BytesParser(policy=email_policy).parsebytes(
+        f"Content-Type: {upload.content_type}\r\n\r\n".encode() + body
+    )
+    parts = {part.get_param("name", header="content-disposition"): part for part in parsed.iter_parts()}
+    assert parts["caption"].get_payload(decode=True).decode() == "📤 история"
+    assert parts["document"].get_filename() == "history.csv"
+    assert parts["document"].get_payload(decode=True) == document.getvalue()
+    # Повтор после 429 читает файл заново
+    assert b"".join(upload) == body
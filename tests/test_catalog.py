@@ -0,0 +1,38 @@
+from catalog import Catalog, normalize
+
+NAMES = ["яблоко", "Курица", "курица гриль", "шоколад", "сок яблочный", "Ёжевика"]
+
+
+def test_normalize_ignores_case_yo_and_spaces():
+    assert normalize("  Ёжевика   лесная ") == "ежевика лесная"
+
+
+def test_lookup_is_exact_up_to_normalization():
+    index = Catalog(NAMES)
+    assert index.lookup("КУРИЦА") == "Курица"
+    assert index.lookup(" курица   гриль ") == "курица гриль"
+    assert index.lookup("ежевика") == "Ёжевика"
+    assert index.lookup("курица 200") is None
+    assert index.lookup("сок") is None
+
+
+def test_prefix_returns_names_in_key_order():
+    index = Catalog(NAMES)
+    assert index.prefix("кур") == ["Курица", "курица гриль"]
+    assert index.prefix("кур", limit=1) == ["Курица"]
+    assert index.prefix("мясо") == []
+
+
+def test_fuzzy_forgives_typos_and_drops_unrelated():
+    index = Catalog(NAMES)
+    assert index.fuzzy("курца")[0] == "Курица"
+    assert index.fuzzy("шоклад") == ["шоколад"]
+    assert index.fuzzy("бульон") == []
+
+
+def test_search_puts_prefix_matches_first_without_duplicates():
+    index = Catalog(NAMES)
+    result = index.search("яблок")
+    assert result[0] == "яблоко"
+    assert len(result) == len(set(result))
+    assert len(index.search("к", limit=2)) == 2
@@ -0,0 +1,97 @@
+import threading
+import time
+from io import BytesIO
+
+import pytest
+
+import outbound
+
+
+class TooManyRequests(Exception):
+    error_code = 429
+
+    def __init__(self, retry_after):
+        super().__init__("Too Many Requests")
+        self.result_json = {"ok": False, "parameters": {"retry_after": retry_after}}
+
+
+def dispatcher(call, **kwargs):
+    settings = dict(workers=4, rate=1000, chat_rate=1000, chat_burst=1000)
+    settings.update(kwargs)
+    return outbound.Dispatcher(call, **settings)
+
+
+# ==================== ПОРЯДОК И ПОВТОРЫ ====================
+def test_requests_of_one_chat_keep_order():
+    calls = []
+
+    def call(method, args, kwargs):
+        time.sleep(0.001)
+        calls.append(args)
+        return args[1]
+    queue = dispatcher(call)
+    futures = [queue.submit(chat_id, "send_message", (chat_id, i), {}) for i in range(20) for chat_id in (1, 2)]
+    assert [f.result(5) for f in futures] == [i for i in range(20) for _ in (1, 2)]
+    for chat_id in (1, 2):
+        assert [args[1] for args in calls if args[0] == chat_id] == list(range(20))
+
+
+def test_429_waits_retry_after_and_rewinds_files():
+    attempts = []
+
+    def call(method, args, kwargs):
+        attempts.append((time.monotonic(), args[1].read()))
+        if len(attempts) == 1:
+            raise TooManyRequests(0.2)
+        return "ok"
+    queue = dispatcher(call)
+    first = queue.submit(1, "send_photo", (1, BytesIO(b"png")), {})
+    second = queue.submit(1, "send_message", (1, BytesIO(b"text")), {})
+    assert first.result(5) == "ok" and second.result(5) == "ok"
+    assert [data for _, data in attempts] == [b"png", b"png", b"text"]
+    assert attempts[1][0] - attempts[0][0] >= 0.2
+
+
+def test_429_gives_up_after_retries():
+    def call(method, args, kwargs):
+        raise TooManyRequests(0)
+    future = dispatcher(call, retries=2).submit(1, "send_message", (1, "x"), {})
+    with pytest.raises(TooManyRequests):
+        future.result(5)
+
+
+# ==================== ПРИОРИТЕТЫ И ЛИМИТЫ ====================
+def test_interactive_requests_go_before_bulk():
+    started, release, order = threading.Event(), threading.Event(), []
+
+    def call(method, args, kwargs):
+        if args[1] == "first":
+            started.set()
+            release.wait(5)
+        order.append(args[1])
+    queue = dispatcher(call, workers=1)
+    queue.submit(1, "send_message", (1, "first"), {})
+    started.wait(5)
+    with outbound.bulk():
+        bulk = [queue.submit(chat_id, "send_document", (chat_id, "bulk"), {}) for chat_id in (2, 3)]
+    interactive = queue.submit(4, "send_message", (4, "interactive"), {})
+    release.set()
+    for future in bulk + [interactive]:
+        future.result(5)
+    assert order == ["first", "interactive", "bulk", "bulk"]
+
+
+def test_chat_rate_limits_only_its_chat():
+    calls = []
+
+    def call(method, args, kwargs):
+        calls.append(args[0])
+    queue = dispatcher(call, chat_rate=0.1, chat_burst=1)
+    queue.submit(1, "send_message", (1, "a"), {}).result(5)
+    delayed = queue.submit(1, "send_message", (1, "b"), {})
+    # Ответы на нажатия кнопок (chat_id=None) и другие чаты не ждут лимита чата 1
+    queue.submit(None, "answer_callback_query", ("q1",), {}).result(5)
+    queue.submit(None, "answer_callback_query", ("q2",), {}).result(5)
+    queue.submit(2, "send_message", (2, "c"), {}).result(5)
+    assert not delayed.done()
+    assert calls == [1, "q1", "q2", 2]
@@ -0,0 +1,60 @@
+import threading
+
+import pytest
+
+import storage
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_store(request, tmp_path):
+    def make(ttl=600):
+        if request.param == "memory":
+            return storage.MemoryStateStore(ttl=ttl)
+        return storage.SqliteStateStore(str(tmp_path / "states.sqlite3"), ttl=ttl)
+    return make
+
+
+def test_pop_returns_state_once(make_store):
+    store = make_store()
+    store.set(42, {"step": "amount", "product": "курица"})
+    assert store.pop("42") == {"step": "amount", "product": "курица"}
+    assert store.pop(42) is None
+
+
+def test_expired_state_is_not_returned(make_store, monkeypatch):
+    store = make_store(ttl=10)
+    now = storage.time.time()
+    store.set(42, {"step": "amount"})
+    monkeypatch.setattr(storage.time, "time", lambda: now + 11)
+    assert store.pop(42) is None
+
+
+def test_set_replaces_and_clear_forgets(make_store):
+    store = make_store()
+    store.set(42, {"step": "amount"})
+    store.set(42, {"step": "add_product"})
+    store.set(43, {"step": "amount"})
+    store.clear(43)
+    assert store.pop(42) == {"step": "add_product"}
+    assert store.pop(43) is None
+
+
+def test_concurrent_pop_hands_state_to_one_caller(make_store):
+    store = make_store()
+    for _ in range(20):
+        store.set(42, {"step": "amount"})
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(store.pop(42))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sum(result is not None for result in results) == 1
+
+
+def test_sqlite_state_is_shared_between_connections(tmp_path):
+    path = str(tmp_path / "states.sqlite3")
+    first, second = storage.SqliteStateStore(path), storage.SqliteStateStore(path)
+    first.set(42, {"step": "amount"})
+    assert second.pop(42) == {"step": "amount"}
+    assert first.pop(42) is None
@@ -0,0 +1,208 @@
+import json
+
+import pytest
+
+import storage
+from history import History, day_number
+
+
+def entry(i, date="2026-10-01"):
+    return {"product": f"продукт {i % 5}", "amount": i + 1, "calories": i, "date": date}
+
+
+def dated_entries(count):
+    return [entry(i, "2026-%02d-%02d" % (1 + i % 9, 1 + i % 4)) for i in range(count)]
+
+
+def exported(store, user_id):
+    return sorted(json.dumps(e, sort_keys=True) for e in store.export_history(user_id))
+
+
+# ==================== ЖУРНАЛ ====================
+def test_torn_tail_is_dropped_on_replay(make_storage):
+    store = make_storage()
+    store.commit({"op": "entry", "user": "7", "entry": entry(1)})
+    log_path = store._user_path("7") + ".wal"
+    with open(log_path, "ab") as f:
+        f.write(b'{"op": "entry", "user": "7", "entry": {"prod')
+
+    reloaded = make_storage()
+    user = reloaded.users.get("7")
+    assert user["total"] == 1
+    assert len(user["history"]) == 1
+    with open(log_path, "rb") as f:
+        assert f.read().endswith(b"\n")
+
+    # Следующая запись не приклеивается к обрезанной строке
+    reloaded.commit({"op": "entry", "user": "7", "entry": entry(2)})
+    assert make_storage().users.get("7")["total"] == 3
+
+
+def test_shared_reader_does_not_truncate_foreign_append(make_storage):
+    writer = make_storage(shared=True)
+    reader = make_storage(shared=True)
+    writer.commit({"op": "entry", "user": "7", "entry": entry(1)})
+    assert reader.users.get("7")["total"] == 1
+    log_path = writer._user_path("7") + ".wal"
+    with open(log_path, "ab") as f:
+        f.write(b'{"op": "entry", "user": "7", "entry": {"prod')
+    size = storage.os.path.getsize(log_path)
+
+    reader.users.get("7")
+    assert storage.os.path.getsize(log_path) == size
+
+
+def test_reload_after_compaction(make_storage, monkeypatch):
+    monkeypatch.setattr(storage, "COMPACT_EVERY", 3)
+    store = make_storage()
+    for i in range(10):
+        store.commit({"op": "entry", "user": "7", "entry": entry(i)})
+    store.commit({"op": "tz", "user": "7", "tz": "Europe/Moscow"})
+    store.flush()
+    before = store.users.get("7")
+
+    after = make_storage().users.get("7")
+    assert after["total"] == before["total"] == sum(range(10))
+    assert after["tz"] == "Europe/Moscow"
+    assert list(after["history"]) == list(before["history"])
+    assert after["daily"] == before["daily"]
+
+
+def test_shared_reader_reloading_mid_compaction_sees_later_events(make_storage, monkeypatch):
+    monkeypatch.setattr(storage, "COMPACT_EVERY", 3)
+    writer = make_storage(shared=True)
+    reader = make_storage(shared=True)
+    write_atomic = storage.write_atomic
+
+    def reload_between_snapshot_and_log(path, payload):
+        # Читатель перечитывает данные между заменой снимка и очисткой журнала
+        write_atomic(path, payload)
+        if path.endswith("7.json"):
+            reader.users.get("7")
+    monkeypatch.setattr(storage, "write_atomic", reload_between_snapshot_and_log)
+
+    for i in range(3):
+        writer.commit({"op": "entry", "user": "7", "entry": entry(i)})
+    monkeypatch.setattr(storage, "write_atomic", write_atomic)
+    monkeypatch.setattr(storage, "COMPACT_EVERY", 1000)
+    # Новый журнал длиннее того, что читатель успел прочитать из старого
+    for i in range(3, 10):
+        writer.commit({"op": "entry", "user": "7", "entry": entry(i, "2026-10-02")})
+    assert reader.users.get("7")["total"] == writer.users.get("7")["total"] == sum(range(10))
+
+
+# ==================== ПРЕДЕЛЫ ЗАПИСЕЙ ====================
+def test_history_rejects_int32_overflow_without_partial_append():
+    history = History([entry(1)])
+    with pytest.raises(OverflowError):
+        history.append(dict(entry(2), amount=2000000000 * 2))
+    with pytest.raises(OverflowError):
+        history.append(dict(entry(2), calories=2 ** 31))
+    assert len(history.days) == len(history.product_ids) == len(history.amounts) == len(history.calories) == 1
+    assert list(history) == [entry(1)]
+
+
+def test_entries_event_is_all_or_nothing(make_storage):
+    store = make_storage()
+    store.commit({"op": "entry", "user": "7", "entry": entry(1)})
+    with pytest.raises(OverflowError):
+        store.commit({"op": "entries", "user": "7", "entries": [entry(2), dict(entry(3), amount=2 ** 40)]})
+    user = store.users.get("7")
+    assert user["total"] == 1
+    assert list(user["history"]) == [entry(1)]
+
+
+# ==================== ХРАНИЛИЩЕ JSON ====================
+def test_json_backend_keeps_history_as_entry_list(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "FLUSH_INTERVAL", 0)
+    monkeypatch.setattr(storage, "HISTORY_RETENTION_DAYS", 0)
+    monkeypatch.chdir(tmp_path)
+    store = storage.JsonStorage()
+    store.commit({"op": "entries", "user": "7", "entries": [entry(1), entry(2)]})
+    store._stopped = True
+    with open(storage.USER_DATA_FILE, encoding="utf-8") as f:
+        assert json.load(f)["7"]["history"] == [entry(1), entry(2)]
+
+    reloaded = storage.JsonStorage()
+    reloaded._stopped = True
+    assert list(reloaded.users["7"]["history"]) == [entry(1), entry(2)]
+    assert reloaded.users["7"]["total"] == 3
+
+
+# ==================== АРХИВ ИСТОРИИ ====================
+def test_export_after_rollup_returns_raw_entries(make_storage):
+    store = make_storage()
+    entries = dated_entries(300)
+    store.commit({"op": "entries", "user": "7", "entries": entries})
+    assert store.rollup_history("7", day_number("2026-05-01")) > 0
+    assert len(store.users.get("7")["history"]) < len(entries)
+    assert exported(store, "7") == sorted(json.dumps(e, sort_keys=True) for e in entries)
+
+
+def test_reset_during_rollup_does_not_bring_back_old_entries(make_storage, monkeypatch):
+    store = make_storage()
+    store.commit({"op": "entries", "user": "7", "entries": dated_entries(30)})
+    truncate_torn_tail = storage.truncate_torn_tail
+
+    def reset_before_append(path):
+        # Сброс из обработчика между чтением записей и событием rollup
+        store.commit({"op": "reset", "user": "7"})
+        store.commit({"op": "entry", "user": "7", "entry": entry(1)})
+        truncate_torn_tail(path)
+    monkeypatch.setattr(storage, "truncate_torn_tail", reset_before_append)
+
+    store.rollup_history("7", day_number("2026-05-01"))
+    assert store.users.get("7")["total"] == 1
+    assert list(store.export_history("7")) == [entry(1)]
+    assert list(make_storage().export_history("7")) == [entry(1)]
+
+    # Следующая свёртка после сброса тоже не возвращает архив до сброса
+    monkeypatch.setattr(storage, "truncate_torn_tail", truncate_torn_tail)
+    store.commit({"op": "entry", "user": "7", "entry": entry(2, "2026-02-01")})
+    store.rollup_history("7", day_number("2026-05-01"))
+    assert exported(store, "7") == sorted(json.dumps(e, sort_keys=True) for e in [entry(1), entry(2, "2026-02-01")])
+
+
+def test_reset_keeps_timezone(make_storage):
+    store = make_storage()
+    store.commit({"op": "tz", "user": "7", "tz": "Asia/Tokyo"})
+    store.commit({"op": "entry", "user": "7", "entry": entry(1)})
+    store.commit({"op": "reset", "user": "7"})
+    assert store.users.get("7")["tz"] == "Asia/Tokyo"
+    assert store.users.get("7")["total"] == 0
+    assert make_storage().users.get("7")["tz"] == "Asia/Tokyo"
+
+
+def test_archive_recovers_after_torn_append(make_storage):
+    store = make_storage()
+    entries = dated_entries(300)
+    store.commit({"op": "entries", "user": "7", "entries": entries})
+    store.rollup_history("7", day_number("2026-03-01"))
+    path = store._archive_path("7")
+    # Сбой посреди дописывания следующего диапазона: заголовок, часть записей, оборванная строка
+    start, before = day_number("2026-03-01"), day_number("2026-05-01")
+    raw = store.users.get("7")["history"].raw_entries(start, before)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"from": start, "before": before, "count": len(raw)}) + "\n")
+        f.write(json.dumps(raw[0], ensure_ascii=False) + "\n")
+        f.write(json.dumps(raw[1], ensure_ascii=False)[:15])
+    want = sorted(json.dumps(e, sort_keys=True) for e in entries)
+    assert exported(store, "7") == want
+
+    store.rollup_history("7", before)
+    assert exported(store, "7") == want
+    assert exported(make_storage(), "7") == want
+
+
+def test_archive_reader_skips_garbage_and_resyncs(make_storage, monkeypatch):
+    store = make_storage()
+    entries = dated_entries(300)
+    store.commit({"op": "entries", "user": "7", "entries": entries})
+    store.rollup_history("7", day_number("2026-03-01"))
+    path = store._archive_path("7")
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("мусор\n{broken json")
+    # Следующий диапазон приклеен к оборванной строке, как дописывали прежние версии
+    monkeypatch.setattr(storage, "truncate_torn_tail", lambda path: None)
+    store.rollup_history("7", day_number("2026-05-01"))
+    assert exported(store, "7") == sorted(json.dumps(e, sort_keys=True) for e in entries)